@@ -7,4 +7,5 @@ setup(
     description='Implementation of a K-Means clustering algorithm to cluster crowd-acquired user stories about smart home applications.',
     author='Diosdavi Lara',
     license='',
+    entry_points={'console_scripts': ['k-means-clustering=src.cli:main']},
 )
@@ -0,0 +1,4 @@
+# -*- coding: utf-8 -*-
+from src.cli import main
+
+main()
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+import click
+import gc
+import json
+import logging
+import platform
+import time
+import tracemalloc
+import numpy as np
+import scipy
+from src.benchmarks.synthetic_corpus import generate_corpus
+from src.features.build_features import build_tfidf
+from src.memory import MemorySize
+from src.models.k_means import INIT_STRATEGIES, KMeans
+
+# Stages of the pipeline that are measured, in order
+STAGES = ('preprocess', 'tfidf', 'fit', 'sse', 'msc')
+
+# Smallest increase over the baseline flagged as a regression for each metric (in seconds and bytes), so the noise
+# of short stages isn't mistaken for one
+DEFAULT_MIN_DIFFERENCES = {'seconds': 0.05, 'peak_memory_bytes': 1024 ** 2}
+
+
+def measure(function, repeat=1, trace_memory=True):
+    """
+    Calls function repeat times and returns its result, the best wall time (in seconds) and the peak memory
+    allocated during an extra traced call (in bytes, or None if trace_memory is False). The memory is traced
+    on a separate call because tracemalloc slows down every allocation.
+    """
+    best_time = None
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        best_time = elapsed if best_time is None else min(best_time, elapsed)
+
+    peak_memory = None
+    if trace_memory:
+        gc.collect()
+        tracemalloc.start()
+        try:
+            function()
+            _, peak_memory = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+    return result, best_time, peak_memory
+
+
+def benchmark_corpus(dataset, k, max_iterations, init, preprocess_rows, repeat, trace_memory, stages=STAGES,
+                     seed=0):
+    """
+    Measures the given stages of the pipeline on a corpus of user stories, and returns a dictionary with the
+    (number of rows processed, seconds, peak memory) of each stage
+    """
+    n_rows = len(dataset)
+    measurements = {}
+    if 'preprocess' in stages:
+        # The NLTK pre-processing is much slower than the rest, so it can run on a sample of the rows
+        from src.data.make_dataset import preprocess_dataset
+        sample = dataset.iloc[:preprocess_rows] if preprocess_rows is not None else dataset
+        measurements['preprocess'] = (len(sample),) + measure(
+            lambda: preprocess_dataset(sample.copy(), jobs=1), repeat, trace_memory)[1:]
+
+    # The synthetic words are already pre-processed, so the rest of the stages use the corpus as it is.
+    # The later stages need the results of the earlier ones, even when these aren't measured.
+    if not set(stages) & {'tfidf', 'fit', 'sse', 'msc'}:
+        return measurements
+    (x, _, _, _), *tfidf_measures = measure(lambda: build_tfidf(dataset), repeat if 'tfidf' in stages else 1,
+                                            trace_memory and 'tfidf' in stages)
+    if 'tfidf' in stages:
+        measurements['tfidf'] = (n_rows,) + tuple(tfidf_measures)
+
+    if not set(stages) & {'fit', 'sse', 'msc'}:
+        return measurements
+    km = KMeans(k=k, max_iterations=max_iterations, init=init, random_state=seed)
+    _, *fit_measures = measure(lambda: km.fit(x), repeat if 'fit' in stages else 1,
+                               trace_memory and 'fit' in stages)
+    if 'fit' in stages:
+        measurements['fit'] = (n_rows,) + tuple(fit_measures)
+    if 'sse' in stages:
+        measurements['sse'] = (n_rows,) + measure(km.get_sse_score, repeat, trace_memory)[1:]
+    if 'msc' in stages:
+        measurements['msc'] = (n_rows,) + measure(km.get_msc_avg, repeat, trace_memory)[1:]
+    return measurements
+
+
+def run_benchmarks(rows, vocabulary_size, k, max_iterations, init, preprocess_rows, repeat, trace_memory,
+                   stages=STAGES, seed=0):
+    """
+    Measures the given stages of the pipeline on a synthetic corpus of each number of rows, and returns the
+    list of results (a dictionary per corpus size and stage)
+    """
+    results = []
+    for n_rows in rows:
+        dataset = generate_corpus(n_rows, vocabulary_size, seed)
+        measurements = benchmark_corpus(dataset, k, max_iterations, init, preprocess_rows, repeat, trace_memory,
+                                        stages, seed)
+        results.extend(get_result(n_rows, stage, *measurements[stage]) for stage in STAGES
+                       if stage in measurements)
+    return results
+
+
+def get_result(n_rows, stage, stage_rows, seconds, peak_memory):
+    """
+    Returns the result of a stage as a dictionary, and logs it
+    """
+    logging.getLogger(__name__).info(str(n_rows) + ' rows, ' + stage + ': ' + '{:.4f}'.format(seconds) + ' s' +
+                                     (', peak memory ' + '{:.1f}'.format(peak_memory / 2 ** 20) + ' MiB'
+                                      if peak_memory is not None else ''))
+    return {'rows': n_rows, 'stage': stage, 'stage_rows': stage_rows, 'seconds': seconds,
+            'rows_per_second': stage_rows / seconds if seconds > 0 else None, 'peak_memory_bytes': peak_memory}
+
+
+def compare_to_baseline(results, baseline, tolerance, min_differences=None):
+    """
+    Compares the results with those of a baseline run, and returns the list of regressions: the stages
+    whose time or peak memory grew by more than the tolerance (a fraction of the baseline value) and by more
+    than the {metric: value} min_differences (DEFAULT_MIN_DIFFERENCES if not given)
+    """
+    if min_differences is None:
+        min_differences = DEFAULT_MIN_DIFFERENCES
+    logger = logging.getLogger(__name__)
+    baseline_results = {(result['rows'], result['stage']): result for result in baseline['results']}
+    regressions = []
+    for result in results:
+        baseline_result = baseline_results.get((result['rows'], result['stage']))
+        if baseline_result is None:
+            continue
+        for metric in ('seconds', 'peak_memory_bytes'):
+            if result[metric] is None or not baseline_result.get(metric):
+                continue
+            ratio = result[metric] / baseline_result[metric]
+            logger.info(str(result['rows']) + ' rows, ' + result['stage'] + ', ' + metric + ': ' +
+                        '{:.2f}'.format(ratio) + 'x the baseline')
+            if ratio > 1 + tolerance and result[metric] - baseline_result[metric] > min_differences.get(metric, 0):
+                regressions.append({'rows': result['rows'], 'stage': result['stage'], 'metric': metric,
+                                    'value': result[metric], 'baseline': baseline_result[metric],
+                                    'ratio': ratio})
+    return regressions
+
+
+@click.command()
+@click.option('--rows', multiple=True, type=int, default=[1000, 10000, 100000],
+              help='Number of rows of a synthetic corpus to measure. Can be given several times.')
+@click.option('--vocabulary-size', default=5000, help='Number of distinct words of the synthetic corpora.')
+@click.option('--k', default=8, help='Number of centroids.')
+@click.option('--max-iterations', default=20, help='Maximum number of iterations of the K-Means algorithm.')
+@click.option('--init', default='k-means++', type=click.Choice(INIT_STRATEGIES),
+              help='Strategy used to pick the initial centroids.')
+@click.option('--preprocess-rows', default=10000, type=int,
+              help='Maximum number of rows of each corpus used to measure the (NLTK) pre-processing.')
+@click.option('--stages', default=','.join(STAGES),
+              help='Comma-separated list of the stages to measure, out of ' + ', '.join(STAGES) + '.')
+@click.option('--repeat', default=5, help='Number of times each stage is timed, keeping the best time.')
+@click.option('--no-memory', is_flag=True, help='Skip the (slower) traced runs that measure the peak memory.')
+@click.option('--output', 'output_filepath', default=None, type=click.Path(),
+              help='JSON file where the results are saved.')
+@click.option('--baseline', 'baseline_filepath', default=None, type=click.Path(exists=True),
+              help='JSON file with the results of a previous run to compare with.')
+@click.option('--tolerance', default=0.2,
+              help='Fraction by which a stage can be slower (or use more memory) than the baseline.')
+@click.option('--min-seconds', default=DEFAULT_MIN_DIFFERENCES['seconds'],
+              help='Smallest increase of the time of a stage over the baseline flagged as a regression.')
+@click.option('--min-memory', default=str(DEFAULT_MIN_DIFFERENCES['peak_memory_bytes']), type=MemorySize(),
+              help='Smallest increase of the peak memory of a stage (e.g. 1MB) flagged as a regression.')
+@click.option('--seed', default=0, help='Random seed of the synthetic corpora and the centroid initialization.')
+def main(rows, vocabulary_size, k, max_iterations, init, preprocess_rows, stages, repeat, no_memory,
+         output_filepath, baseline_filepath, tolerance, min_seconds, min_memory, seed):
+    """
+    Measures the time and the peak memory of every stage of the pipeline on synthetic corpora of user stories,
+    optionally failing if any of them regressed against a baseline run.
+    """
+    logger = logging.getLogger(__name__)
+    stages = tuple(stage.strip() for stage in stages.split(','))
+    unknown_stages = set(stages) - set(STAGES)
+    if unknown_stages:
+        raise click.UsageError('Unknown stages: ' + ', '.join(sorted(unknown_stages)))
+    if 'preprocess' in stages:
+        from src.data.make_dataset import check_nltk_resources
+        try:
+            check_nltk_resources()
+        except click.ClickException as error:
+            logger.warning(error.message + ' Skipping the preprocess stage.')
+            stages = tuple(stage for stage in stages if stage != 'preprocess')
+
+    results = run_benchmarks(rows, vocabulary_size, k, max_iterations, init, preprocess_rows, repeat,
+                             not no_memory, stages, seed)
+    report = {
+        'environment': {'python': platform.python_version(), 'numpy': np.__version__, 'scipy': scipy.__version__,
+                        'platform': platform.platform(), 'processor': platform.processor()},
+        'parameters': {'vocabulary_size': vocabulary_size, 'k': k, 'max_iterations': max_iterations, 'init': init,
+                       'preprocess_rows': preprocess_rows, 'repeat': repeat, 'seed': seed},
+        'results': results,
+    }
+    if output_filepath is not None:
+        with open(output_filepath, 'w', encoding='utf-8') as file:
+            json.dump(report, file, indent=2)
+        logger.info('Saved the benchmark results on ' + output_filepath)
+
+    if baseline_filepath is not None:
+        with open(baseline_filepath, encoding='utf-8') as file:
+            baseline = json.load(file)
+        regressions = compare_to_baseline(results, baseline, tolerance,
+                                          {'seconds': min_seconds, 'peak_memory_bytes': min_memory})
+        for regression in regressions:
+            logger.error('Regression: ' + str(regression['rows']) + ' rows, ' + regression['stage'] + ', ' +
+                         regression['metric'] + ' went from ' + str(regression['baseline']) + ' to ' +
+                         str(regression['value']))
+        if regressions:
+            raise click.ClickException(str(len(regressions)) + ' regressions against the baseline ' +
+                                       baseline_filepath)
+        logger.info('No regressions against the baseline ' + baseline_filepath)
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    main()
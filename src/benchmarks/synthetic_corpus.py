@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+import click
+import logging
+import numpy as np
+import pandas as pd
+
+# Syllables combined to make up the words of the synthetic vocabulary
+CONSONANTS = 'bcdfghjklmnprstvz'
+VOWELS = 'aeiou'
+
+# Range (min, max) of the number of words in each column of a synthetic user story
+COLUMN_LENGTHS = {'role': (1, 2), 'feature': (3, 8), 'benefit': (2, 6)}
+
+# Exponent of the Zipf distribution of the word frequencies
+ZIPF_EXPONENT = 1.1
+
+
+def get_synthetic_vocabulary(size):
+    """
+    Returns a list of size distinct made-up words, built from consonant-vowel syllables
+    """
+    syllables = [consonant + vowel for consonant in CONSONANTS for vowel in VOWELS]
+    vocabulary = []
+    n_syllables = 2
+    while len(vocabulary) < size:
+        # Enumerate the words of n_syllables syllables, in order
+        for position in range(len(syllables) ** n_syllables):
+            word = ''
+            for _ in range(n_syllables):
+                position, syllable = divmod(position, len(syllables))
+                word += syllables[syllable]
+            vocabulary.append(word)
+            if len(vocabulary) == size:
+                break
+        n_syllables += 1
+    return vocabulary
+
+
+def generate_corpus(n_rows, vocabulary_size=5000, seed=0):
+    """
+    Generates a dataset of n_rows synthetic user stories, with the columns of the raw dataset ('id', 'role',
+    'feature' and 'benefit'). The words are drawn from a vocabulary of vocabulary_size made-up words with
+    Zipf distributed frequencies, like those of natural language.
+    """
+    rng = np.random.default_rng(seed)
+    vocabulary = np.array(get_synthetic_vocabulary(vocabulary_size))
+    probabilities = 1.0 / np.arange(1, vocabulary_size + 1) ** ZIPF_EXPONENT
+    probabilities /= probabilities.sum()
+
+    dataset = {'id': np.arange(1, n_rows + 1)}
+    for column, (min_length, max_length) in COLUMN_LENGTHS.items():
+        lengths = rng.integers(min_length, max_length + 1, size=n_rows)
+        words = vocabulary[rng.choice(vocabulary_size, size=int(lengths.sum()), p=probabilities)]
+        ends = np.cumsum(lengths)
+        dataset[column] = [' '.join(words[end - length:end]) for end, length in zip(ends, lengths)]
+    return pd.DataFrame(dataset)
+
+
+@click.command()
+@click.argument('output_filepath', type=click.Path())
+@click.option('--rows', default=1000, help='Number of user stories.')
+@click.option('--vocabulary-size', default=5000, help='Number of distinct words.')
+@click.option('--seed', default=0, help='Random seed of the generator.')
+def main(output_filepath, rows, vocabulary_size, seed):
+    """
+    Generates a synthetic dataset of user stories as a .csv file with the columns of the raw dataset
+    """
+    logger = logging.getLogger(__name__)
+    dataset = generate_corpus(rows, vocabulary_size, seed)
+    dataset.to_csv(output_filepath, index=False)
+    logger.info('Saved ' + str(rows) + ' synthetic user stories on ' + output_filepath)
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    main()
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+import importlib
+import logging
+import click
+
+# Subcommands of the command line, as (module, command, short help). The module of a subcommand is only
+# imported when it runs, so short commands don't pay for loading NLTK, pandas or matplotlib.
+COMMANDS = {
+    'download-nltk': ('src.data.make_dataset', 'download_nltk',
+                      'Download the NLTK resources used by the pre-processing (needs network access).'),
+    'preprocess': ('src.data.make_dataset', 'main', 'Pre-process the raw user stories (Step 1).'),
+    'features': ('src.features.build_features', 'main', 'Build the TF-IDF scores of the user stories (Step 2).'),
+    'reduce': ('src.features.reduce_features', 'main', 'Prune and project the TF-IDF scores to fewer dimensions.'),
+    'train': ('src.models.train_model', 'main', 'Train the K-Means clustering algorithm (Step 3).'),
+    'update': ('src.models.update_model', 'main', 'Add new user stories to an incrementally updated model.'),
+    'predict': ('src.models.predict_model', 'main', 'Assign raw user stories to the clusters of a saved model.'),
+    'serve': ('src.models.serve_model', 'main', 'Serve the clusters of a saved model over HTTP.'),
+    'report': ('src.visualization.visualize', 'main', 'Plot the SSE and MSC scores of each K (Step 4).'),
+    'pipeline': ('src.pipeline.run_pipeline', 'main', 'Run every step with cached stage outputs.'),
+    'benchmark': ('src.benchmarks.run_benchmarks', 'main', 'Measure the time and memory of every step.'),
+    'synthetic-corpus': ('src.benchmarks.synthetic_corpus', 'main', 'Generate a synthetic dataset of user stories.'),
+}
+
+
+class LazyGroup(click.Group):
+    """
+    Group of commands that imports the module of each subcommand only when it is invoked
+    """
+
+    def list_commands(self, ctx):
+        return sorted(COMMANDS)
+
+    def get_command(self, ctx, name):
+        if name not in COMMANDS:
+            return None
+        module_name, command_name, _ = COMMANDS[name]
+        return getattr(importlib.import_module(module_name), command_name)
+
+    def format_commands(self, ctx, formatter):
+        # The help of the group lists the short help of every subcommand without importing them
+        with formatter.section('Commands'):
+            formatter.write_dl([(name, COMMANDS[name][2]) for name in self.list_commands(ctx)])
+
+
+@click.group(cls=LazyGroup)
+def cli():
+    """
+    Clustering of crowd-acquired user stories about smart home applications with K-Means
+    """
+
+
+def main():
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    cli()
+
+
+if __name__ == '__main__':
+    main()
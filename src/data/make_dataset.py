@@ -1,17 +1,42 @@
 # -*- coding: utf-8 -*-
 import json
 import os
-import nltk
 import click
 import logging
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from functools import lru_cache
 from pathlib import Path
-from nltk.stem import WordNetLemmatizer
-import pandas as pd
-from nltk.corpus import wordnet
+
+# POS tags of the words that are kept: nouns, verbs, adjectives and adverbs
+KEPT_POS_TAGS = frozenset(["NN", "VB", "VBD", "VBG", "VBN", "VBP", "VBZ", "JJ", "RB"])
+
+# Maximum number of (word, POS) pairs whose lemma is remembered
+LEMMA_CACHE_SIZE = 100000
+
+# Number of rows sent at once to each worker process
+PREPROCESS_CHUNK_SIZE = 500
+
+# Columns of the dataset with the text of the user stories
+TEXT_COLUMNS = ['role', 'feature', 'benefit']
+
+# Files with the standard and the custom domain stopwords
+STOPWORDS_FILENAMES = ('stopwords.json', 'stopwords_custom.json')
+
+# NLTK resources used by the pre-processing, as (path on the NLTK data folders, package) alternatives: newer
+# NLTK versions load the tokenizer and the tagger from the punkt_tab and averaged_perceptron_tagger_eng
+# packages instead of the older ones
+NLTK_RESOURCES = {
+    'tokenizer': (('tokenizers/punkt_tab', 'punkt_tab'), ('tokenizers/punkt', 'punkt')),
+    'tagger': (('taggers/averaged_perceptron_tagger_eng', 'averaged_perceptron_tagger_eng'),
+               ('taggers/averaged_perceptron_tagger', 'averaged_perceptron_tagger')),
+    'lemmatizer': (('corpora/wordnet', 'wordnet'),),
+}
 
 
 def get_wordnet_pos(tag):
     """Map POS tag to first character lemmatize() accepts"""
+    from nltk.corpus import wordnet
     tag_dict = {"J": wordnet.ADJ,
                 "N": wordnet.NOUN,
                 "V": wordnet.VERB,
@@ -30,6 +55,79 @@ def get_stopwords(filename):
     return data
 
 
+@lru_cache(maxsize=None)
+def get_stopword_set(filename):
+    """
+    Returns the stopwords of a .JSON file as a frozenset, loading the file only the first time
+    """
+    return frozenset(get_stopwords(filename))
+
+
+@lru_cache(maxsize=None)
+def get_lemmatizer():
+    from nltk.stem import WordNetLemmatizer
+    return WordNetLemmatizer()
+
+
+@lru_cache(maxsize=None)
+def find_nltk_resources():
+    """
+    Looks up the NLTK resources of the pre-processing on the local NLTK data folders, without any network
+    access, and returns the names of those that aren't installed. The result is remembered by the process.
+    """
+    import nltk
+    missing = []
+    for name, alternatives in NLTK_RESOURCES.items():
+        for path, _ in alternatives:
+            try:
+                nltk.data.find(path)
+                break
+            except LookupError:
+                continue
+        else:
+            missing.append(name)
+    return missing
+
+
+def check_nltk_resources():
+    """
+    Raises a usage error if any NLTK resource of the pre-processing isn't installed, telling how to get it
+    """
+    missing = [name + ' (' + ' or '.join(package for _, package in NLTK_RESOURCES[name]) + ')'
+               for name in find_nltk_resources()]
+    if missing:
+        raise click.ClickException('Missing NLTK resources: ' + ', '.join(missing) + '. Install them once with '
+                                   '\'python -m src download-nltk\' (or nltk.download).')
+
+
+@lru_cache(maxsize=LEMMA_CACHE_SIZE)
+def lemmatize(word, tag):
+    """
+    Returns the lemma of a word given its POS tag, remembering the most recently used ones
+    """
+    return get_lemmatizer().lemmatize(word, get_wordnet_pos(tag))
+
+
+def preprocess_batch(texts):
+    """
+    Applies the pre-processing steps of preprocess to a list of strings, POS-tagging all of them in a single
+    batch, and returns the list of pre-processed strings
+    """
+    standard_stop_words = get_stopword_set(STOPWORDS_FILENAMES[0])
+    custom_stop_words = get_stopword_set(STOPWORDS_FILENAMES[1])
+
+    import nltk
+    tokenized_texts = [nltk.word_tokenize(text.lower().replace('/', ' ')) for text in texts]
+    preprocessed_texts = []
+    for tagged_tokens in nltk.pos_tag_sents(tokenized_texts):
+        # Retain the nouns, verbs, adjectives and adverbs that are not stop words, and lemmatize them
+        lemmatized_tokens = [lemmatize(word, tag) for word, tag in tagged_tokens
+                             if tag in KEPT_POS_TAGS and word not in standard_stop_words
+                             and word not in custom_stop_words]
+        preprocessed_texts.append(' '.join(lemmatized_tokens))
+    return preprocessed_texts
+
+
 def preprocess(text):
     """
     Applies the following pre-processing steps to a given string:
@@ -40,56 +138,129 @@ def preprocess(text):
     Step 5: Remove custom domain stopwords
     Step 6: Lemmatize each word
     """
-    tokens = nltk.word_tokenize(text.lower().replace('/', ' '))
-    tagged_tokens = nltk.pos_tag(tokens)
-    filtered_tokens = [t for t in tagged_tokens if t[1] in ["NN", "VB", "VBD", "VBG", "VBN", "VBP", "VBZ", "JJ", "RB"]]
+    return preprocess_batch([text])[0]
+
+
+def get_preprocessing_config():
+    """
+    Returns the settings of the pre-processing steps, saved along with the trained models
+    """
+    return {'text_columns': TEXT_COLUMNS, 'kept_pos_tags': sorted(KEPT_POS_TAGS),
+            'stopwords': list(STOPWORDS_FILENAMES)}
+
+
+def _preprocess_chunk(chunk):
+    """
+    Pre-processes every text column of a chunk of rows (a dictionary of lists)
+    """
+    return {column: preprocess_batch(texts) for column, texts in chunk.items()}
 
-    # Remove stop words
-    standard_stop_words = get_stopwords("stopwords.json")
-    custom_stop_words = get_stopwords("stopwords_custom.json")
-    tokens_no_standr_stopwords = [word for word in filtered_tokens if word[0] not in standard_stop_words]
-    tokens_no_custom_stopwords = [word for word in tokens_no_standr_stopwords if word[0] not in custom_stop_words]
 
-    # Lemmatize
-    wordnet_lemmatizer = WordNetLemmatizer()
-    lemmatized_tokens = [wordnet_lemmatizer.lemmatize(w[0], get_wordnet_pos(w[1])) for w in tokens_no_custom_stopwords]
+def preprocess_dataset(dataset, columns=TEXT_COLUMNS, jobs=1, chunk_size=PREPROCESS_CHUNK_SIZE, executor=None):
+    """
+    Applies the pre-processing steps on the given columns of the dataset, in chunks of rows spread across
+    a pool of jobs processes (or in this process if jobs is 1). An existing executor can be given instead,
+    to reuse its worker processes across several calls.
+    """
+    chunks = [{column: dataset[column].iloc[start:start + chunk_size].tolist() for column in columns}
+              for start in range(0, len(dataset), chunk_size)]
+    if executor is not None:
+        results = list(executor.map(_preprocess_chunk, chunks))
+    elif jobs == 1:
+        results = list(map(_preprocess_chunk, chunks))
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            results = list(executor.map(_preprocess_chunk, chunks))
 
-    preprocessed_text = ' '.join(lemmatized_tokens)
-    return preprocessed_text
+    preprocessed = {column: [] for column in columns}
+    for result in results:
+        for column in columns:
+            preprocessed[column].extend(result[column])
+    for column in columns:
+        dataset[column] = preprocessed[column]
+    return dataset
+
+
+def preprocess_file_chunked(input_filepath, output_filepath, chunksize, jobs=1):
+    """
+    Streams the raw dataset in chunks of chunksize rows: each chunk is pre-processed and appended to the
+    output file before the next one is read, so only one chunk is in memory at a time. The chunks are spread
+    across a pool of jobs processes (or pre-processed in this process if jobs is 1). Returns the number of rows.
+    """
+    import pandas as pd
+    logger = logging.getLogger(__name__)
+    n_rows = 0
+    with ProcessPoolExecutor(max_workers=jobs) if jobs > 1 else nullcontext() as executor:
+        reader = pd.read_csv(input_filepath, usecols=['id', 'role', 'feature', 'benefit'], chunksize=chunksize)
+        for position, chunk in enumerate(reader):
+            chunk = preprocess_dataset(chunk, TEXT_COLUMNS, executor=executor)
+            chunk.to_csv(output_filepath, encoding='utf-8', index=False, mode='w' if position == 0 else 'a',
+                         header=(position == 0))
+            n_rows += len(chunk)
+            logger.info('Pre-processed ' + str(n_rows) + ' rows')
+    return n_rows
 
 
 @click.command()
 @click.argument('input_filepath', type=click.Path(exists=True))
 @click.argument('output_filepath', type=click.Path())
-def main(input_filepath, output_filepath):
+@click.option('--jobs', default=None, type=int,
+              help='Number of worker processes for the pre-processing. Defaults to the number of CPUs.')
+@click.option('--chunksize', default=None, type=int,
+              help='Stream the dataset in chunks of this many rows, keeping only one chunk in memory.')
+def main(input_filepath, output_filepath, jobs, chunksize):
     """ Runs data processing scripts to turn raw data from (../raw) into
         cleaned data ready to be analyzed (saved in ../processed).
     """
     logger = logging.getLogger(__name__)
     logger.info('Making final data set from raw data')
 
+    # Check the NLTK resources locally, they are only downloaded by download_nltk
+    check_nltk_resources()
+
+    if chunksize is not None:
+        n_rows = preprocess_file_chunked(input_filepath, output_filepath, chunksize, jobs or os.cpu_count())
+        logger.info('Saved processed results on ' + output_filepath + ' with ' + str(n_rows) + ' rows')
+        return
+
+    # pandas is only needed to read and write the dataset, not by the worker processes
+    import pandas as pd
+
     # Get the data/raw/smarthome-userstories-1k.csv file
     # Also excludes the last column from each row due to extra commas on the csv
     dataset = pd.read_csv(input_filepath, usecols=['id', 'role', 'feature', 'benefit'])
     logger.info('Loaded data file ' + input_filepath + ' with ' + str(len(dataset)) + ' rows')
 
-    # Download NLTK resources
-    nltk.download('punkt')
-    nltk.download('averaged_perceptron_tagger')
-    nltk.download('wordnet')
-
-    logger.info('Applying pre-processing steps on the "Role" column...')
-    dataset['role'] = dataset['role'].apply(preprocess)
-    logger.info('Applying pre-processing steps on the "Feature" column...')
-    dataset['feature'] = dataset['feature'].apply(preprocess)
-    logger.info('Applying pre-processing steps on the "Benefit" column...')
-    dataset['benefit'] = dataset['benefit'].apply(preprocess)
+    logger.info('Applying pre-processing steps on the "Role", "Feature" and "Benefit" columns...')
+    dataset = preprocess_dataset(dataset, TEXT_COLUMNS, jobs or os.cpu_count())
 
     # Save the processed subset on data data/processed/smarthome-userstories.csv
     logger.info('Saved processed results on ' + output_filepath + ' with ' + str(len(dataset)) + ' rows')
     dataset.to_csv(output_filepath, encoding='utf-8', index=False)
 
 
+@click.command()
+@click.option('--download-dir', default=None, type=click.Path(),
+              help='NLTK data folder where the resources are installed. Defaults to the first one NLTK uses.')
+def download_nltk(download_dir):
+    """
+    Downloads the NLTK resources used by the pre-processing that aren't installed yet
+    """
+    import nltk
+    logger = logging.getLogger(__name__)
+    missing = find_nltk_resources()
+    if not missing:
+        logger.info('All the NLTK resources are installed')
+        return
+    # Every alternative package of a missing resource is installed, as only one of them works on each NLTK version
+    for name in missing:
+        for _, package in NLTK_RESOURCES[name]:
+            if not nltk.download(package, download_dir=download_dir, quiet=True):
+                raise click.ClickException('Could not download the NLTK package ' + package)
+            logger.info('Downloaded the NLTK package ' + package)
+    find_nltk_resources.cache_clear()
+
+
 if __name__ == '__main__':
     log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
     logging.basicConfig(level=logging.INFO, format=log_fmt)
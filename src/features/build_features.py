@@ -1,97 +1,197 @@
 # -*- coding: utf-8 -*-
 import click
 import logging
-import math
-import pandas as pd
-import copy
+import numpy as np
+from scipy import sparse
+from src.data.make_dataset import TEXT_COLUMNS
+from src.features.feature_store import CSRStoreWriter, save_features
+from src.memory import DTYPES, MemorySize, get_rows_per_block
 
+# Number of copies of each densified row held while writing the .csv table (the dense scores and the
+# DataFrame built from them)
+CSV_ROW_COPIES = 2
 
-def get_vocabulary_set(dataset):
-    """ Create the keyword associated to the position of the elements within the document vectors """
-    vocabulary_string = ""
-    for column in dataset:
-        if column != 'id':
-            column_list = dataset[column].tolist()
-            vocabulary_string = vocabulary_string + " ".join(map(str, column_list))
 
-    tokens = vocabulary_string.split(' ')
-    vocabulary_set = set(tokens)
-    return vocabulary_set
-
-
-def get_vector_bow(row):
-    """ Given a dataframe row with an user story, return the bag of words (BoW) across the
-        'Role', 'Feature' and 'Benefit' columns of that user story
+def get_bow(*texts):
+    """ Given the pre-processed texts of an user story, return the bag of words (BoW) (the set of distinct
+        words) across all of them
     """
-    bow_role = str(row['role']).split(' ')
-    bow_feature = str(row['feature']).split(' ')
-    bow_benefit = str(row['benefit']).split(' ')
-
-    bow_total = set(bow_role).union(set(bow_feature)).union(set(bow_benefit))
+    bow_total = set()
+    for text in texts:
+        bow_total.update(str(text).split(' '))
     return bow_total
 
 
-def populate_vector_dimensions(vector_dict, dataset):
+def iter_bows(dataset):
     """
-    Returns a vector dictionary with the dimension values populated based on the dataset info
+    Yields the bag of words of each user story in the dataset, in order
     """
-    vector_dict_copy = copy.deepcopy(vector_dict)
-    for index, row in dataset.iterrows():
-        bow = get_vector_bow(row)
-        for word in bow:
-            vector_id = row['id']
-            vector_dict_copy[vector_id][word] = vector_dict_copy[vector_id][word] + 1
-    return vector_dict_copy
+    for texts in zip(*(dataset[column] for column in TEXT_COLUMNS)):
+        yield get_bow(*texts)
 
 
-def compute_tf(vector, bow):
+def build_tfidf(dataset, dtype=np.float64):
     """
-    Computes the Term Frequency of a vector, where:
+    Builds the TF-IDF scores of the user stories, where:
         tf(w) = (Number of times the word appears in a user story) / (Total number of words in the user story)
+        idf(w) = log(Number of user stories / Number of user stories that contain word w )
+    The document frequencies are counted first, and the scores are then computed with transform, like the
+    chunked and incremental paths do.
+    Returns the scores as a sparse CSR matrix of the given dtype (one row per user story, one column per
+    word), the user story IDs of the rows, the vocabulary list of the columns (in alphabetical order) and
+    their idfs.
     """
-    tf_dict = {}
-    bow_count = len(bow)
-    for word, count in vector.items():
-        tf_dict[word] = count / float(bow_count)
-    return tf_dict
+    vocabulary_index = {}
+    document_frequencies = []
+    count_document_frequencies(dataset, vocabulary_index, document_frequencies)
+    vocabulary, vocabulary_index, idfs = sort_vocabulary(vocabulary_index, document_frequencies, len(dataset))
+    return transform(dataset, vocabulary_index, idfs, dtype), dataset['id'].values, vocabulary, idfs
 
 
-def compute_idf(dataset):
+def count_document_frequencies(dataset, vocabulary_index, document_frequencies):
+    """
+    Adds the words of the user stories in the dataset to the {word: column} vocabulary index, and counts on
+    the document_frequencies list the number of user stories that contain each one.
+    Returns the number of non-zero TF-IDF scores of these user stories (their number of distinct words).
+    """
+    nnz = 0
+    for bow in iter_bows(dataset):
+        for word in bow:
+            column = vocabulary_index.get(word)
+            if column is None:
+                column = vocabulary_index[word] = len(document_frequencies)
+                document_frequencies.append(0)
+            document_frequencies[column] += 1
+        nnz += len(bow)
+    return nnz
+
+
+def compute_idfs(document_frequencies, n_documents):
     """
     Computes the Inverse Document Frequency of all words, where:
         idf(w) = log(Number of user stories / Number of user stories that contain word w )
     """
-    total_rows = len(dataset)
+    return np.log(n_documents / np.asarray(document_frequencies, dtype=float))
+
+
+def sort_vocabulary(vocabulary_index, document_frequencies, n_documents):
+    """
+    Sorts the words of a {word: column} vocabulary index, with the document frequencies of its columns, in
+    alphabetical order. Returns the sorted vocabulary list, its new {word: column} index and the idfs of
+    its words.
+    """
+    vocabulary = sorted(vocabulary_index)
+    idfs = compute_idfs([document_frequencies[vocabulary_index[word]] for word in vocabulary], n_documents)
+    return vocabulary, {word: column for column, word in enumerate(vocabulary)}, idfs
+
+
+def transform(dataset, vocabulary_index, idfs, dtype=np.float64):
+    """
+    Returns the TF-IDF scores of the user stories as a sparse CSR matrix of the given dtype, over the words
+    of an existing {word: column} vocabulary index with their idfs. Words outside of the vocabulary get no
+    column, but they still count towards the total number of words of their user story.
+    """
+    indptr = [0]
+    indices = []
+    term_frequencies = []
+    for bow in iter_bows(dataset):
+        columns = [vocabulary_index[word] for word in bow if word in vocabulary_index]
+        indices.extend(columns)
+        term_frequencies.extend([1.0 / len(bow)] * len(columns))
+        indptr.append(len(indices))
+    indices = np.array(indices, dtype=np.int64)
+    scores = (np.array(term_frequencies) * np.asarray(idfs)[indices]).astype(dtype, copy=False)
+    matrix = sparse.csr_matrix((scores, indices, np.array(indptr)), shape=(len(indptr) - 1, len(idfs)))
+    matrix.sort_indices()
+    return matrix
+
+
+def read_dataset(input_filepath, chunksize=None):
+    """
+    Reads the pre-processed dataset, or an iterator over chunks of chunksize rows of it.
+    Also excludes the last column from each row due to extra commas on the csv
+    """
+    # pandas is only loaded to read or write .csv files, the models only need the transform
+    import pandas as pd
+    return pd.read_csv(input_filepath, usecols=['id', 'role', 'feature', 'benefit'], chunksize=chunksize)
 
-    # counts the number of documents that contain a word w
-    idf_dict = dict.fromkeys(get_vocabulary_set(dataset), 0)
-    for index, row in dataset.iterrows():
-        bow_row = get_vector_bow(row)
-        for word in bow_row:
-            idf_dict[word] += 1
 
-    # divide total_rows by denominator above, take the log of that
-    for word, val in idf_dict.items():
-        if float(val) > 0:
-            idf_dict[word] = math.log(total_rows / float(val))
+def build_tfidf_chunked(input_filepath, output_filepath, chunksize, export_csv=False, dtype=np.float64):
+    """
+    Builds the TF-IDF scores of the user stories in two streaming passes over chunks of chunksize rows of
+    the dataset: the first one counts the document frequencies, the second one computes the scores of each
+    chunk and appends them to the output (a feature store, or a .csv table if export_csv is set).
+    Only one chunk of the dataset and of the scores is in memory at a time. Returns the number of rows.
+    """
+    logger = logging.getLogger(__name__)
 
-    return idf_dict
+    logger.info('Counting the document frequencies of each word...')
+    vocabulary_index = {}
+    document_frequencies = []
+    n_documents = 0
+    nnz = 0
+    for chunk in read_dataset(input_filepath, chunksize):
+        nnz += count_document_frequencies(chunk, vocabulary_index, document_frequencies)
+        n_documents += len(chunk)
+
+    # Sort the vocabulary alphabetically, like build_tfidf does
+    vocabulary, vocabulary_index, idfs = sort_vocabulary(vocabulary_index, document_frequencies, n_documents)
+
+    logger.info('Generating the TF-IDF scores for each chunk of ' + str(chunksize) + ' rows...')
+    if export_csv:
+        with open(output_filepath, 'w', encoding='utf-8', newline='') as file:
+            for position, chunk in enumerate(read_dataset(input_filepath, chunksize)):
+                write_csv_rows(file, transform(chunk, vocabulary_index, idfs, dtype), chunk['id'].values,
+                               vocabulary, header=(position == 0))
+    else:
+        writer = CSRStoreWriter(output_filepath, (n_documents, len(vocabulary)), nnz, vocabulary, dtype=dtype,
+                                idfs=idfs)
+        for chunk in read_dataset(input_filepath, chunksize):
+            writer.write_rows(transform(chunk, vocabulary_index, idfs, dtype), chunk['id'].values)
+        writer.close()
+    return n_documents
+
+
+def write_csv_rows(file, tfidf_matrix, ids, vocabulary, header=True):
+    """
+    Writes rows of the TF-IDF matrix on an open .csv file, with one column per word of the vocabulary
+    """
+    import pandas as pd
+    dataframe_scores = pd.DataFrame(tfidf_matrix.toarray(), index=ids, columns=vocabulary)
+    dataframe_scores.to_csv(file, header=header)
 
 
-def compute_tfidf(tf_bow, idfs):
+def get_csv_chunk_size(tfidf_matrix, max_memory):
     """
-    Computes the TF-IDF of a user story, based on the TF and IDF results
+    Returns the number of rows of the TF-IDF matrix that can be densified together to write them on a .csv
+    table without going over max_memory bytes
     """
-    tfidf = {}
-    for word, val in tf_bow.items():
-        tfidf[word] = val * idfs[word]
-    return tfidf
+    return get_rows_per_block(max_memory, CSV_ROW_COPIES * tfidf_matrix.dtype.itemsize * tfidf_matrix.shape[1])
+
+
+def write_tfidf_csv(tfidf_matrix, ids, vocabulary, filepath, chunk_size=1000):
+    """
+    Writes the TF-IDF matrix as a .csv table with one column per word of the vocabulary.
+    Only chunk_size rows are densified at a time while writing the file.
+    """
+    with open(filepath, 'w', encoding='utf-8', newline='') as file:
+        for start in range(0, tfidf_matrix.shape[0], chunk_size):
+            end = min(start + chunk_size, tfidf_matrix.shape[0])
+            write_csv_rows(file, tfidf_matrix[start:end], ids[start:end], vocabulary, header=(start == 0))
 
 
 @click.command()
 @click.argument('input_filepath', type=click.Path(exists=True))
 @click.argument('output_filepath', type=click.Path())
-def main(input_filepath, output_filepath):
+@click.option('--csv', 'export_csv', is_flag=True,
+              help='Export the scores as a .csv table instead of the binary feature store.')
+@click.option('--chunksize', default=None, type=int,
+              help='Stream the dataset in chunks of this many rows, keeping only one chunk in memory.')
+@click.option('--dtype', default='float64', type=click.Choice(DTYPES),
+              help='Floating point type of the scores. float32 halves the size of the feature store.')
+@click.option('--max-memory', default=None, type=MemorySize(),
+              help='Memory budget (e.g. 512MB, 2GB) of the rows densified at a time for the --csv export.')
+def main(input_filepath, output_filepath, export_csv, chunksize, dtype, max_memory):
     """
     Starting point of the project. Receives the location of the dataset as a
     command-line Path argument.
@@ -99,46 +199,29 @@ def main(input_filepath, output_filepath):
     logger = logging.getLogger(__name__)
     logger.info('Making final TD-IDF scores set from processed data')
 
+    if chunksize is not None:
+        n_rows = build_tfidf_chunked(input_filepath, output_filepath, chunksize, export_csv, dtype)
+        logger.info('Saved processed scores on ' + output_filepath + ' with ' + str(n_rows) + ' rows')
+        return
+
     # Get the data/processed/smarthome-userstories.csv file
-    # Also excludes the last column from each row due to extra commas on the csv
-    dataset = pd.read_csv(input_filepath, usecols=['id', 'role', 'feature', 'benefit'])
+    dataset = read_dataset(input_filepath)
     logger.info('Loaded data file ' + input_filepath + ' with ' + str(len(dataset)) + ' rows')
 
-    # Generates the set with all the words used across all user stories
-    vocabulary_set = get_vocabulary_set(dataset)
-
-    # List of vector dictionaries, in which each vector is a user story
-    # Each vector has another dictionary with vector dimensions of each word from the vocabulary set
-    vector_dict = dict.fromkeys(dataset['id'].tolist())
-
-    for key, value in vector_dict.items():
-        vector_dict[key] = dict.fromkeys(vocabulary_set, 0)
-
-    logger.info('Populating the user story vectors based on the dataset...')
-    vector_dict_populated = populate_vector_dimensions(vector_dict, dataset)
-    idfs = compute_idf(dataset)
-
-    # Generate the tf-idf scores dictionary
+    # Generates the TF-IDF scores of each user story, along with the list of all the words used
     logger.info('Generating the TF-IDF scores for each vector...')
-    tfidf_scores_dict = {}
-    for index, row in dataset.iterrows():
-        row_id = row['id']
-        tf_bow = compute_tf(vector_dict_populated[row_id], get_vector_bow(row))
-        tfidf_bow = compute_tfidf(tf_bow, idfs)
-        tfidf_scores_dict[row_id] = tfidf_bow
-
-    # Generate new DataFrame with the TF-IDF scores
-    logger.info('Saving TF-IDF scores in a new .csv file...')
-    tfidf_scores = []
-    tfidf_ids = []
-    for data in tfidf_scores_dict.items():
-        tfidf_ids.append(data[0])
-        tfidf_scores.append(data[1])
-    dataframe_scores = pd.DataFrame(tfidf_scores, index=tfidf_ids, columns=get_vocabulary_set(dataset))
-
-    # Save the TF-IDF scores on data models/tf-idf-scores.csv
+    tfidf_matrix, tfidf_ids, vocabulary, idfs = build_tfidf(dataset, dtype)
+
+    if export_csv:
+        # Save the TF-IDF scores on data models/tf-idf-scores.csv
+        logger.info('Saving TF-IDF scores in a new .csv file...')
+        chunk_size = get_csv_chunk_size(tfidf_matrix, max_memory) if max_memory is not None else 1000
+        write_tfidf_csv(tfidf_matrix, tfidf_ids, vocabulary, output_filepath, chunk_size)
+    else:
+        # Save the TF-IDF scores on the models/tf-idf-scores feature store folder
+        logger.info('Saving TF-IDF scores in a new feature store...')
+        save_features(output_filepath, tfidf_matrix, tfidf_ids, vocabulary, idfs)
     logger.info('Saved processed scores on ' + output_filepath + ' with ' + str(len(dataset)) + ' rows')
-    dataframe_scores.to_csv(output_filepath, encoding='utf-8')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+from contextlib import contextmanager
+import numpy as np
+from scipy import sparse
+
+# String constants
+FORMAT_FILENAME = 'format.json'
+VOCABULARY_FILENAME = 'vocabulary.json'
+IDS_FILENAME = 'ids.npy'
+DENSE_MATRIX_FILENAME = 'matrix.npy'
+IDFS_FILENAME = 'idfs.npy'
+CSR_ARRAY_FILENAMES = {'data': 'data.npy', 'indices': 'indices.npy', 'indptr': 'indptr.npy'}
+
+
+def is_feature_store(path):
+    """
+    Returns True if the given path is a folder created by save_features
+    """
+    return os.path.isfile(os.path.join(path, FORMAT_FILENAME))
+
+
+def start_folder_write(folder, marker_filename):
+    """
+    Creates a folder to write a set of files on (a feature store, a model...), which is recognized by a .json
+    marker file. The marker of any previous write is removed first, so the folder isn't recognized while the
+    new files are being written.
+    """
+    os.makedirs(folder, exist_ok=True)
+    marker_filepath = os.path.join(folder, marker_filename)
+    if os.path.isfile(marker_filepath):
+        os.remove(marker_filepath)
+
+
+def finish_folder_write(folder, marker_filename, marker):
+    """
+    Writes the .json marker file of a folder once all its other files exist. It is written on a temporary
+    file and renamed, so a partial marker is never read either.
+    """
+    marker_filepath = os.path.join(folder, marker_filename)
+    with open(marker_filepath + '.tmp', 'w', encoding='utf-8') as file:
+        json.dump(marker, file)
+    os.replace(marker_filepath + '.tmp', marker_filepath)
+
+
+@contextmanager
+def write_folder(folder, marker_filename):
+    """
+    Yields a dictionary with the content of the .json marker file of a folder, which is written with
+    finish_folder_write once the files of the folder are written in the context without errors
+    """
+    start_folder_write(folder, marker_filename)
+    marker = {}
+    yield marker
+    finish_folder_write(folder, marker_filename, marker)
+
+
+def _save_vocabulary(folder, vocabulary, idfs=None):
+    """
+    Saves the vocabulary of the columns of a store, along with the idf of each word if given
+    """
+    with open(os.path.join(folder, VOCABULARY_FILENAME), 'w', encoding='utf-8') as file:
+        json.dump(list(vocabulary), file)
+    idfs_filepath = os.path.join(folder, IDFS_FILENAME)
+    if idfs is not None:
+        np.save(idfs_filepath, np.asarray(idfs, dtype=float))
+    elif os.path.isfile(idfs_filepath):
+        os.remove(idfs_filepath)
+
+
+def save_features(folder, matrix, ids, vocabulary, idfs=None):
+    """
+    Saves a (dense or sparse) feature matrix on the given folder as a set of binary .npy arrays,
+    along with the user story IDs of its rows and a .json sidecar with the vocabulary of its columns.
+    The idf of each word of the vocabulary can be saved with them, so models can transform new user stories.
+    """
+    with write_folder(folder, FORMAT_FILENAME) as store_format:
+        ids = np.asarray(ids)
+        if ids.dtype == object:
+            ids = ids.astype(str)
+        np.save(os.path.join(folder, IDS_FILENAME), ids)
+        _save_vocabulary(folder, vocabulary, idfs)
+
+        if sparse.issparse(matrix):
+            matrix = sparse.csr_matrix(matrix)
+            matrix.sort_indices()
+            for attribute, filename in CSR_ARRAY_FILENAMES.items():
+                np.save(os.path.join(folder, filename), getattr(matrix, attribute))
+            layout = 'csr'
+        else:
+            matrix = np.asarray(matrix)
+            np.save(os.path.join(folder, DENSE_MATRIX_FILENAME), matrix)
+            layout = 'dense'
+        store_format.update(layout=layout, shape=list(matrix.shape), dtype=str(matrix.dtype))
+
+
+def load_features(folder, mmap=True):
+    """
+    Loads the feature matrix, the row IDs and the vocabulary saved on the given folder.
+    By default the arrays are memory-mapped (read-only), so nothing is parsed or copied until it is used.
+    """
+    mmap_mode = 'r' if mmap else None
+    with open(os.path.join(folder, FORMAT_FILENAME), encoding='utf-8') as file:
+        store_format = json.load(file)
+    with open(os.path.join(folder, VOCABULARY_FILENAME), encoding='utf-8') as file:
+        vocabulary = json.load(file)
+    ids = np.load(os.path.join(folder, IDS_FILENAME), mmap_mode=mmap_mode)
+
+    if store_format['layout'] == 'csr':
+        arrays = [np.load(os.path.join(folder, CSR_ARRAY_FILENAMES[attribute]), mmap_mode=mmap_mode)
+                  for attribute in ('data', 'indices', 'indptr')]
+        matrix = sparse.csr_matrix(tuple(arrays), shape=tuple(store_format['shape']), copy=False)
+        matrix.has_sorted_indices = True
+    else:
+        matrix = np.load(os.path.join(folder, DENSE_MATRIX_FILENAME), mmap_mode=mmap_mode)
+    return matrix, ids, vocabulary
+
+
+def load_idfs(folder):
+    """
+    Returns the idf of each word of the vocabulary of a feature store, or None if they weren't saved with it
+    """
+    idfs_filepath = os.path.join(folder, IDFS_FILENAME)
+    if not os.path.isfile(idfs_filepath):
+        return None
+    return np.load(idfs_filepath)
+
+
+class CSRStoreWriter:
+    """
+    Writes a sparse CSR feature store one chunk of rows at a time, straight into memory-mapped .npy files,
+    so the whole matrix never has to be in memory. The shape and the number of non-zero values of the
+    matrix must be known in advance.
+    """
+
+    def __init__(self, folder, shape, nnz, vocabulary, dtype=np.float64, ids_dtype=np.int64, idfs=None):
+        start_folder_write(folder, FORMAT_FILENAME)
+        self.folder = folder
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        _save_vocabulary(folder, vocabulary, idfs)
+
+        index_dtype = np.int32 if max(nnz, shape[1]) < np.iinfo(np.int32).max else np.int64
+        self._arrays = {
+            'data': np.lib.format.open_memmap(os.path.join(folder, CSR_ARRAY_FILENAMES['data']), mode='w+',
+                                              dtype=self.dtype, shape=(nnz,)),
+            'indices': np.lib.format.open_memmap(os.path.join(folder, CSR_ARRAY_FILENAMES['indices']),
+                                                 mode='w+', dtype=index_dtype, shape=(nnz,)),
+            'indptr': np.lib.format.open_memmap(os.path.join(folder, CSR_ARRAY_FILENAMES['indptr']),
+                                                mode='w+', dtype=index_dtype, shape=(shape[0] + 1,)),
+            'ids': np.lib.format.open_memmap(os.path.join(folder, IDS_FILENAME), mode='w+', dtype=ids_dtype,
+                                             shape=(shape[0],)),
+        }
+        self._arrays['indptr'][0] = 0
+        self._row = 0
+        self._nnz = 0
+
+    def write_rows(self, matrix, ids):
+        """
+        Appends a chunk of rows (a sparse matrix) along with their IDs
+        """
+        matrix = sparse.csr_matrix(matrix)
+        matrix.sort_indices()
+        n_rows, nnz = matrix.shape[0], matrix.nnz
+        self._arrays['data'][self._nnz:self._nnz + nnz] = matrix.data
+        self._arrays['indices'][self._nnz:self._nnz + nnz] = matrix.indices
+        self._arrays['indptr'][self._row + 1:self._row + n_rows + 1] = matrix.indptr[1:] + self._nnz
+        self._arrays['ids'][self._row:self._row + n_rows] = ids
+        self._row += n_rows
+        self._nnz += nnz
+
+    def close(self):
+        """
+        Flushes the arrays to disk and writes the format file, which makes the store readable
+        """
+        for array in self._arrays.values():
+            array.flush()
+        self._arrays = {}
+        finish_folder_write(self.folder, FORMAT_FILENAME,
+                            {'layout': 'csr', 'shape': list(self.shape), 'dtype': str(self.dtype)})
+
+
+def iter_feature_chunks(folder, chunksize):
+    """
+    Yields the (matrix, ids) chunks of chunksize rows of a feature store, reading them from the memory-mapped
+    arrays so only one chunk is loaded at a time
+    """
+    matrix, ids, _ = load_features(folder, mmap=True)
+    for start in range(0, matrix.shape[0], chunksize):
+        end = min(start + chunksize, matrix.shape[0])
+        yield matrix[start:end], np.asarray(ids[start:end])
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+import click
+import logging
+import numpy as np
+from scipy import sparse
+from src.features.feature_store import is_feature_store, load_features, load_idfs, save_features
+from src.memory import DTYPES
+
+# Methods available to reduce the dimensions of the feature matrix
+REDUCTION_METHODS = ('svd', 'random-projection', 'none')
+
+# Prefix of the names given to the columns of a reduced matrix, which no longer stand for words
+COMPONENT_PREFIX = 'component-'
+
+
+def get_document_frequencies(matrix):
+    """
+    Returns the number of rows of a (dense or sparse) feature matrix where each column is non-zero
+    """
+    if sparse.issparse(matrix):
+        matrix = sparse.csr_matrix(matrix)
+        return np.bincount(matrix.indices[matrix.data != 0], minlength=matrix.shape[1])
+    return np.count_nonzero(matrix, axis=0)
+
+
+def select_features(document_frequencies, n_rows, min_df=1, max_df=1.0, max_features=None):
+    """
+    Returns the (sorted) indices of the columns kept by the document frequency pruning: those that appear in at
+    least min_df rows and in at most a max_df fraction of them. Given max_features, only that many of them are
+    kept, the most frequent ones first (ties are broken by column).
+    """
+    document_frequencies = np.asarray(document_frequencies)
+    kept = np.flatnonzero((document_frequencies >= min_df) & (document_frequencies <= max_df * n_rows))
+    if max_features is not None and len(kept) > max_features:
+        order = np.argsort(-document_frequencies[kept], kind='stable')
+        kept = np.sort(kept[order[:max_features]])
+    return kept
+
+
+def randomized_svd(matrix, n_components, n_oversamples=10, n_iter=4, random_state=None):
+    """
+    Returns the n_components largest singular values of a (dense or sparse) matrix, with their left singular
+    vectors and their right singular vectors (the components, one per row), using the randomized range
+    finder of Halko et al.: the matrix is multiplied by a few more random vectors than components, refined with
+    n_iter power iterations, and only the SVD of its projection on that small subspace is computed exactly.
+    """
+    rng = np.random.default_rng(random_state)
+    n_samples = min(n_components + n_oversamples, min(matrix.shape))
+    basis, _ = np.linalg.qr(np.asarray(matrix @ rng.standard_normal((matrix.shape[1], n_samples))))
+    for _ in range(n_iter):
+        # Each power iteration sharpens the decay of the singular values, re-orthonormalized for stability
+        basis, _ = np.linalg.qr(np.asarray(matrix.T @ basis))
+        basis, _ = np.linalg.qr(np.asarray(matrix @ basis))
+
+    projection = np.asarray(matrix.T @ basis).T
+    left_vectors, singular_values, components = np.linalg.svd(projection, full_matrices=False)
+    left_vectors = basis @ left_vectors
+    return left_vectors[:, :n_components], singular_values[:n_components], components[:n_components]
+
+
+def get_random_projection(n_features, n_components, density=None, random_state=None):
+    """
+    Returns a sparse (n_features x n_components) random projection matrix, with a density fraction of its
+    values set to +/-sqrt(1 / (density * n_components)) and the rest to zero. With the default density of
+    1 / sqrt(n_features), it preserves the pairwise distances of the rows (in expectation) like a dense
+    Gaussian projection does, at a fraction of the cost.
+    """
+    rng = np.random.default_rng(random_state)
+    if density is None:
+        density = 1 / np.sqrt(n_features)
+    n_values = rng.binomial(n_features * n_components, density)
+    positions = rng.choice(n_features * n_components, size=n_values, replace=False)
+    values = np.where(rng.random(n_values) < 0.5, -1.0, 1.0) * np.sqrt(1 / (density * n_components))
+    rows, columns = np.divmod(positions, n_components)
+    return sparse.csr_matrix((values, (rows, columns)), shape=(n_features, n_components))
+
+
+def reduce_features(matrix, method='svd', n_components=100, random_state=None):
+    """
+    Returns the rows of the feature matrix projected to n_components dimensions with the given method, as a
+    dense array: 'svd' keeps the largest singular directions (Latent Semantic Analysis), while
+    'random-projection' multiplies the matrix by a sparse random one
+    """
+    n_components = min(n_components, min(matrix.shape))
+    if method == 'svd':
+        left_vectors, singular_values, _ = randomized_svd(matrix, n_components, random_state=random_state)
+        return left_vectors * singular_values
+    projection = get_random_projection(matrix.shape[1], n_components, random_state=random_state)
+    reduced = matrix @ projection
+    if sparse.issparse(reduced):
+        reduced = reduced.toarray()
+    return np.asarray(reduced)
+
+
+def get_squared_norm(matrix):
+    """
+    Returns the squared Frobenius norm of a (dense or sparse) matrix
+    """
+    if sparse.issparse(matrix):
+        return float(matrix.multiply(matrix).sum())
+    return float(np.sum(np.square(matrix)))
+
+
+@click.command()
+@click.argument('input_folder', type=click.Path(exists=True))
+@click.argument('output_folder', type=click.Path())
+@click.option('--min-df', default=1, help='Drop the words that appear in fewer user stories than this.')
+@click.option('--max-df', default=1.0,
+              help='Drop the words that appear in a larger fraction of the user stories than this.')
+@click.option('--max-features', default=None, type=int, help='Keep only this many words, the most frequent ones.')
+@click.option('--method', default='svd', type=click.Choice(REDUCTION_METHODS),
+              help='Projection of the kept words: randomized truncated SVD (LSA), sparse random projection, or none '
+                   'to only prune the vocabulary.')
+@click.option('--n-components', default=100, help='Number of dimensions of the projected features.')
+@click.option('--seed', default=None, type=int, help='Random seed of the projection.')
+@click.option('--dtype', default='float64', type=click.Choice(DTYPES), help='Floating point type of the output.')
+def main(input_folder, output_folder, min_df, max_df, max_features, method, n_components, seed, dtype):
+    """
+    Prunes the vocabulary of the feature store built by build_features by document frequency, and projects
+    the scores to fewer dimensions, saving them as a new feature store for train_model.
+    """
+    logger = logging.getLogger(__name__)
+    if not is_feature_store(input_folder):
+        raise click.UsageError(input_folder + ' is not a feature store built by build_features')
+
+    matrix, ids, vocabulary = load_features(input_folder, mmap=True)
+    logger.info('Loaded feature store ' + input_folder + ' with ' + str(matrix.shape[0]) + ' rows and ' +
+                str(matrix.shape[1]) + ' words')
+
+    kept = select_features(get_document_frequencies(matrix), matrix.shape[0], min_df, max_df, max_features)
+    matrix = matrix[:, kept]
+    vocabulary = [vocabulary[column] for column in kept]
+    logger.info('Kept ' + str(len(kept)) + ' words after the document frequency pruning')
+
+    if method == 'none':
+        idfs = load_idfs(input_folder)
+        # The pruned store keeps the idfs of its words, so models can still be saved from it
+        save_features(output_folder, matrix.astype(dtype), ids, vocabulary, idfs[kept] if idfs is not None else None)
+        logger.info('Saved the pruned features on ' + output_folder)
+        return
+
+    logger.info('Projecting the features to ' + str(n_components) + ' dimensions with ' + method + '...')
+    reduced = reduce_features(matrix, method, n_components, seed)
+    if method == 'svd':
+        logger.info('The components keep ' + '{:.1%}'.format(get_squared_norm(reduced) /
+                                                             max(get_squared_norm(matrix), 1e-12)) +
+                    ' of the squared norm of the features')
+    components = [COMPONENT_PREFIX + str(component) for component in range(reduced.shape[1])]
+    save_features(output_folder, reduced.astype(dtype), ids, components)
+    logger.info('Saved the reduced features on ' + output_folder + ' with ' + str(reduced.shape[1]) + ' dimensions')
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    main()
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+import re
+import click
+
+# Multipliers of the units accepted in memory sizes
+MEMORY_UNITS = {'': 1, 'B': 1, 'K': 1024, 'KB': 1024, 'M': 1024 ** 2, 'MB': 1024 ** 2, 'G': 1024 ** 3,
+                'GB': 1024 ** 3, 'T': 1024 ** 4, 'TB': 1024 ** 4}
+
+# Floating point types available for the scores and the centroids (float32 halves their memory)
+DTYPES = ('float64', 'float32')
+
+
+def parse_memory_size(size):
+    """
+    Returns the number of bytes of a memory size given as a number of bytes or a string like '512MB' or '2GB'
+    """
+    if isinstance(size, (int, float)):
+        return int(size)
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([a-zA-Z]*)\s*', str(size))
+    if match is None or match.group(2).upper() not in MEMORY_UNITS:
+        raise ValueError('Invalid memory size: ' + str(size) + ', expected a number of bytes or e.g. 512MB, 2GB')
+    return int(float(match.group(1)) * MEMORY_UNITS[match.group(2).upper()])
+
+
+def get_rows_per_block(max_memory, row_bytes):
+    """
+    Returns the number of rows of a block that fit in max_memory bytes, given the bytes taken by each row
+    """
+    return max(1, int(max_memory // max(row_bytes, 1)))
+
+
+class MemorySize(click.ParamType):
+    """
+    Command-line parameter type of a memory size, converted to a number of bytes
+    """
+    name = 'memory size'
+
+    def convert(self, value, param, ctx):
+        try:
+            return parse_memory_size(value)
+        except ValueError as error:
+            self.fail(str(error), param, ctx)
@@ -1,7 +1,30 @@
-import numpy as np
-import random
+import copy
+import logging
 import math
-from statistics import mean
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from scipy import sparse
+from src.memory import get_rows_per_block
+
+# Number of rows whose distances are computed together in a single matrix product
+DEFAULT_BLOCK_SIZE = 4096
+
+# Number of arrays with a value per centroid (similarities, distances, bounds...) held for each row of a block
+BLOCK_ARRAYS_PER_ROW = 4
+
+# Strategies available to pick the initial centroids
+INIT_STRATEGIES = ('random', 'k-means++', 'k-means||')
+
+# Algorithms available to assign the data points to the centroids on each iteration
+ALGORITHMS = ('lloyd', 'elkan', 'hamerly')
+
+# Criteria available to decide when the centroids have converged
+CONVERGENCE_CRITERIA = ('shift', 'inertia', 'labels')
+
+# Model and data used by each worker process of the n_init restarts
+_restart_state = None
 
 
 def dot_product(a, b):
@@ -31,124 +54,845 @@ def get_cosine_distance(a, b):
     return 1 - cosine_similarity(a, b)
 
 
+def as_data_matrix(data, dtype=np.float64):
+    """
+    Returns the given data as a float matrix of the given dtype, keeping sparse input in CSR format instead
+    of densifying it. Data that already has the right format is not copied.
+    """
+    if sparse.issparse(data):
+        return sparse.csr_matrix(data, dtype=dtype)
+    return np.asarray(data, dtype=dtype)
+
+
+def get_dense_rows(data, rows):
+    """
+    Returns a dense copy of the selected rows of a (dense or sparse) data matrix
+    """
+    if sparse.issparse(data):
+        return data[rows].toarray()
+    return np.array(data[rows], dtype=data.dtype)
+
+
+def get_block_size(data, k, max_memory):
+    """
+    Returns the number of rows of data whose distances to k centroids can be computed together in a block
+    without going over max_memory bytes: the block holds a few arrays of k values per row, along with a copy
+    of its rows (the non-zero values of a sparse matrix, or every column of a dense one)
+    """
+    n_rows = max(data.shape[0], 1)
+    if sparse.issparse(data):
+        row_bytes = (data.data.itemsize + data.indices.itemsize) * data.nnz / n_rows
+    else:
+        row_bytes = data.dtype.itemsize * data.shape[1]
+    row_bytes += np.dtype(np.float64).itemsize * BLOCK_ARRAYS_PER_ROW * k
+    return get_rows_per_block(max_memory, row_bytes)
+
+
+def get_row_ids(data, ids=None):
+    """
+    Returns the IDs of the rows in data as an array, using the position of each row if no IDs are given
+    """
+    if ids is None:
+        return np.arange(data.shape[0])
+    ids = np.asarray(ids)
+    if ids.shape != (data.shape[0],):
+        raise ValueError('Expected ' + str(data.shape[0]) + ' IDs, one for each row, got ' + str(len(ids)))
+    return ids
+
+
+def get_row_norms(data):
+    """
+    Returns the L2 norm of each row in a 2D (dense or sparse) array
+    """
+    if sparse.issparse(data):
+        return np.sqrt(np.asarray(data.multiply(data).sum(axis=1)).ravel())
+    return np.sqrt(np.einsum('ij,ij->i', data, data))
+
+
+def get_membership_matrix(labels, k):
+    """
+    Returns a sparse (k x N) matrix with a 1 on the column of each data point, on the row of its cluster.
+    Multiplying it by the data matrix sums the data points of each cluster.
+    """
+    n_rows = len(labels)
+    return sparse.csr_matrix((np.ones(n_rows), (labels, np.arange(n_rows))), shape=(k, n_rows))
+
+
+def get_inverse_norms(data):
+    """
+    Returns the inverse of the L2 norm of each row in a 2D array, using 0 for the rows that are all zeros
+    (which keeps the cosine similarity of an empty vector at 0, like cosine_similarity does)
+    """
+    norms = get_row_norms(data)
+    inverse_norms = np.zeros_like(norms)
+    np.divide(1.0, norms, out=inverse_norms, where=norms > 0)
+    return inverse_norms
+
+
+def assign_clusters(data, centroids, inverse_norms=None, block_size=DEFAULT_BLOCK_SIZE):
+    """
+    Returns the index of the closest centroid (by cosine distance) for every row in data, together with
+    the cosine distance to that centroid.
+    The rows are L2-normalized through their precomputed inverse norms, so all the point-to-centroid
+    distances of a block of rows come out of a single matrix product.
+    """
+    if inverse_norms is None:
+        inverse_norms = get_inverse_norms(data)
+    normalized_centroids = centroids * get_inverse_norms(centroids)[:, np.newaxis]
+
+    n_rows = data.shape[0]
+    labels = np.empty(n_rows, dtype=np.intp)
+    distances = np.empty(n_rows)
+    for start in range(0, n_rows, block_size):
+        end = min(start + block_size, n_rows)
+        similarities = np.asarray(data[start:end] @ normalized_centroids.T)
+        similarities *= inverse_norms[start:end, np.newaxis]
+        block_labels = np.argmax(similarities, axis=1)
+        labels[start:end] = block_labels
+        distances[start:end] = 1 - similarities[np.arange(end - start), block_labels]
+    return labels, distances
+
+
+def update_centroids(centroids, data, labels):
+    """
+    Re-calculates in place the centroids as the average of the data points assigned to them, using a
+    scatter-add of the rows over their labels. A centroid without any data points keeps its position.
+    """
+    k = centroids.shape[0]
+    sums = get_membership_matrix(labels, k) @ data
+    if sparse.issparse(sums):
+        sums = sums.toarray()
+    counts = np.bincount(labels, minlength=k)
+    non_empty = counts > 0
+    centroids[non_empty] = sums[non_empty] / counts[non_empty, np.newaxis]
+    return counts
+
+
+def get_point_distances(data, centroids, labels, inverse_norms=None, block_size=DEFAULT_BLOCK_SIZE):
+    """
+    Returns the cosine distance between every row in data and the centroid given by its label.
+    The rows are grouped by label, so each one is only multiplied by its own centroid.
+    """
+    if inverse_norms is None:
+        inverse_norms = get_inverse_norms(data)
+    normalized_centroids = centroids * get_inverse_norms(centroids)[:, np.newaxis]
+
+    distances = np.empty(data.shape[0])
+    order = np.argsort(labels, kind='stable')
+    counts = np.bincount(labels, minlength=centroids.shape[0])
+    ends = np.cumsum(counts)
+    for j in range(centroids.shape[0]):
+        for start in range(ends[j] - counts[j], ends[j], block_size):
+            rows = order[start:min(start + block_size, ends[j])]
+            similarities = np.asarray(data[rows] @ normalized_centroids[j]).ravel()
+            distances[rows] = 1 - similarities * inverse_norms[rows]
+    return distances
+
+
+def get_normalized_cluster_sums(data, labels, k, inverse_norms):
+    """
+    Returns the sum of the L2-normalized data points of each cluster (a k x D array)
+    """
+    # The membership matrix scaled by the inverse norms does the normalization
+    membership = get_membership_matrix(labels, k).multiply(inverse_norms[np.newaxis, :])
+    cluster_sums = membership.tocsr() @ data
+    if sparse.issparse(cluster_sums):
+        cluster_sums = cluster_sums.toarray()
+    return np.asarray(cluster_sums)
+
+
+def get_silhouette_coefficients(data, labels, cluster_sums, counts, inverse_norms, points=None,
+                                block_size=DEFAULT_BLOCK_SIZE):
+    """
+    Returns the silhouette coefficient of the data points in points (all of them by default), given the
+    sum of the normalized data points and the number of data points of each cluster.
+    On L2-normalized vectors, the average cosine distance between a point x and the points y of a cluster
+    is 1 - x . sum(y) / |cluster|, so the coefficients take O(k * D) per point instead of O(N * D).
+    """
+    if points is None:
+        points = np.arange(data.shape[0])
+    non_empty = counts > 0
+    cluster_means = cluster_sums[non_empty] / counts[non_empty, np.newaxis]
+    # Position of each cluster among the non-empty ones
+    cluster_positions = np.cumsum(non_empty) - 1
+
+    coefficients = np.empty(len(points))
+    for start in range(0, len(points), block_size):
+        end = min(start + block_size, len(points))
+        block_points = points[start:end]
+
+        # Average distance between each point and the points inside every cluster
+        cluster_similarities = np.asarray(data[block_points] @ cluster_means.T)
+        avg_distances = 1 - cluster_similarities * inverse_norms[block_points, np.newaxis]
+
+        # Average distance to the points in the same cluster (a) and in the closest other cluster (b)
+        own_cluster = cluster_positions[labels[block_points]]
+        rows = np.arange(end - start)
+        avg_a = avg_distances[rows, own_cluster]
+        avg_distances[rows, own_cluster] = np.inf
+        min_b = np.min(avg_distances, axis=1)
+
+        # Calculate the silhouette coefficient for each point
+        coefficients[start:end] = (min_b - avg_a) / np.maximum(avg_a, min_b)
+    return coefficients
+
+
+def normalize_centroids(centroids):
+    """
+    Returns a copy of the centroids scaled to unit L2 norm (a centroid that is all zeros stays that way)
+    """
+    return centroids * get_inverse_norms(centroids)[:, np.newaxis]
+
+
+def get_chord_distances(data, normalized_centroids, inverse_norms, rows, block_size=DEFAULT_BLOCK_SIZE):
+    """
+    Returns sqrt(2 * cosine distance) between the data points in rows and the centroids, which is the
+    Euclidean distance between their L2-normalized vectors. It ranks the centroids like the cosine distance
+    does, but it satisfies the triangle inequality. An empty vector has a cosine distance of 1 to everything,
+    so it is treated as a point at sqrt(2) from all the others (and not at 1, as its zero norm would give),
+    which still satisfies it.
+    """
+    distances = np.empty((len(rows), normalized_centroids.shape[0]))
+    for start in range(0, len(rows), block_size):
+        block_rows = rows[start:start + block_size]
+        similarities = np.asarray(data[block_rows] @ normalized_centroids.T)
+        similarities *= inverse_norms[block_rows, np.newaxis]
+        distances[start:start + len(block_rows)] = np.sqrt(np.maximum(2 - 2 * similarities, 0))
+    return distances
+
+
+def get_chord_distances_to_centroids(data, normalized_centroids, inverse_norms, rows, centroid_indices,
+                                     block_size=DEFAULT_BLOCK_SIZE):
+    """
+    Returns the distance of get_chord_distances between each data point in rows and a single centroid per
+    point, given by centroid_indices. The rows are grouped by centroid, like get_point_distances does, so
+    each one is only multiplied by its own centroid and no copy of the centroids is made per row.
+    """
+    rows = np.asarray(rows)
+    centroid_indices = np.asarray(centroid_indices)
+    similarities = np.empty(len(rows))
+    order = np.argsort(centroid_indices, kind='stable')
+    counts = np.bincount(centroid_indices, minlength=normalized_centroids.shape[0])
+    ends = np.cumsum(counts)
+    for j in np.flatnonzero(counts):
+        for start in range(ends[j] - counts[j], ends[j], block_size):
+            positions = order[start:min(start + block_size, ends[j])]
+            similarities[positions] = np.asarray(data[rows[positions]] @ normalized_centroids[j]).ravel()
+    similarities *= inverse_norms[rows]
+    return np.sqrt(np.maximum(2 - 2 * similarities, 0))
+
+
+def get_centroid_shifts(normalized_centroids, previous_centroids):
+    """
+    Returns how far each normalized centroid moved from its previous position, by the distance of
+    get_chord_distances: a centroid that became empty (or stopped being so) is sqrt(2) away from its previous
+    position, while one that stays empty doesn't move
+    """
+    shifts = np.sqrt(np.maximum(2 - 2 * np.sum(normalized_centroids * previous_centroids, axis=1), 0))
+    shifts[~np.any(normalized_centroids != 0, axis=1) & ~np.any(previous_centroids != 0, axis=1)] = 0
+    return shifts
+
+
+def assign_clusters_bounded(algorithm, data, centroids, inverse_norms, bounds=None, block_size=DEFAULT_BLOCK_SIZE):
+    """
+    Assigns every data point to its closest centroid like assign_clusters, but keeps for each point an upper
+    bound of the distance to its centroid and lower bounds of the distances to the other centroids
+    (one per centroid for 'elkan', a single one for 'hamerly'). After the centroids move, the triangle
+    inequality on the normalized vectors rules out most of the distance computations.
+    The upper bounds left loose are tightened at the end, so the distance of every point to its centroid is
+    exact. Returns the labels, these cosine distances, the bounds to pass on the next call, and the number of
+    point-to-centroid distances that did not need to be computed.
+    """
+    n_rows = data.shape[0]
+    k = centroids.shape[0]
+    normalized_centroids = normalize_centroids(centroids)
+    all_rows = np.arange(n_rows)
+
+    if bounds is None:
+        # First assignment, every distance is computed to initialize the bounds
+        distances = get_chord_distances(data, normalized_centroids, inverse_norms, all_rows, block_size)
+        labels = np.argmin(distances, axis=1)
+        upper = distances[all_rows, labels]
+        if algorithm == 'elkan':
+            lower = distances
+        else:
+            distances[all_rows, labels] = np.inf
+            lower = np.min(distances, axis=1) if k > 1 else np.full(n_rows, np.inf)
+        # The upper bounds start out tight, they equal the actual distances
+        tight = np.ones(n_rows, dtype=bool)
+        bounds = {'labels': labels, 'upper': upper, 'lower': lower, 'tight': tight,
+                  'centroids': normalized_centroids}
+        return labels, upper ** 2 / 2, bounds, 0
+
+    labels = bounds['labels']
+    upper = bounds['upper']
+    lower = bounds['lower']
+    tight = bounds['tight']
+
+    # Move the bounds by the distance each centroid has moved since the last assignment
+    shifts = get_centroid_shifts(normalized_centroids, bounds['centroids'])
+    upper += shifts[labels]
+    tight &= shifts[labels] == 0
+    if algorithm == 'elkan':
+        lower -= shifts[np.newaxis, :]
+        np.maximum(lower, 0, out=lower)
+    elif k > 1:
+        # The lower bound may refer to any other centroid, so it moves by the largest shift among them
+        order = np.argsort(shifts)
+        largest_other_shift = np.where(labels == order[-1], shifts[order[-2]], shifts[order[-1]])
+        lower -= largest_other_shift
+
+    # Half the distance from each centroid to its closest other centroid
+    centroid_distances = np.sqrt(np.maximum(2 - 2 * normalized_centroids @ normalized_centroids.T, 0))
+    np.fill_diagonal(centroid_distances, np.inf)
+    half_closest = 0.5 * np.min(centroid_distances, axis=1) if k > 1 else np.full(k, np.inf)
+
+    n_computed = 0
+    if algorithm == 'elkan':
+        candidates = np.flatnonzero(upper > half_closest[labels])
+        # Tighten the upper bound of the candidates before checking the centroids one by one
+        loose = candidates[~tight[candidates]]
+        upper[loose] = get_chord_distances_to_centroids(data, normalized_centroids, inverse_norms, loose,
+                                                        labels[loose], block_size)
+        tight[loose] = True
+        n_computed += len(loose)
+        # The pairs of candidates and other centroids that the bounds can't rule out are computed all at once,
+        # grouped by centroid, on a copy of the lower bounds of the candidates only
+        candidate_labels = labels[candidates]
+        candidate_upper = upper[candidates, np.newaxis]
+        candidate_lower = lower[candidates]
+        candidate_lower[np.arange(len(candidates)), candidate_labels] = upper[candidates]
+        needed = candidate_upper > np.maximum(candidate_lower, 0.5 * centroid_distances[candidate_labels])
+        # Taken from the transpose, the pairs come out already grouped by centroid
+        centroid_indices, positions = np.nonzero(needed.T)
+        if len(positions) > 0:
+            new_distances = get_chord_distances_to_centroids(data, normalized_centroids, inverse_norms,
+                                                             candidates[positions], centroid_indices, block_size)
+            n_computed += len(positions)
+            candidate_lower[positions, centroid_indices] = new_distances
+            # The centroids that weren't computed are no closer than the current one, so each row moves to the
+            # closest of its current centroid and the computed ones
+            distances = np.where(needed, candidate_lower, np.inf)
+            distances[np.arange(len(candidates)), candidate_labels] = upper[candidates]
+            new_labels = np.argmin(distances, axis=1)
+            labels[candidates] = new_labels
+            upper[candidates] = distances[np.arange(len(candidates)), new_labels]
+        lower[candidates] = candidate_lower
+    else:
+        candidates = np.flatnonzero(upper > np.maximum(half_closest[labels], lower))
+        # Tighten the upper bound of the candidates, and check every centroid for those that still fail
+        loose = candidates[~tight[candidates]]
+        upper[loose] = get_chord_distances_to_centroids(data, normalized_centroids, inverse_norms, loose,
+                                                        labels[loose], block_size)
+        tight[loose] = True
+        n_computed += len(loose)
+        rows = candidates[upper[candidates] > np.maximum(half_closest[labels[candidates]], lower[candidates])]
+        if len(rows) > 0:
+            # The distance to the current centroid is already known, the other k - 1 are new
+            distances = get_chord_distances(data, normalized_centroids, inverse_norms, rows, block_size)
+            n_computed += len(rows) * (k - 1)
+            labels[rows] = np.argmin(distances, axis=1)
+            upper[rows] = distances[np.arange(len(rows)), labels[rows]]
+            distances[np.arange(len(rows)), labels[rows]] = np.inf
+            lower[rows] = np.min(distances, axis=1)
+
+    # The inertia needs the exact distance of the points that weren't candidates too, and tight bounds rule
+    # out more distances on the next call
+    loose = np.flatnonzero(~tight)
+    upper[loose] = get_chord_distances_to_centroids(data, normalized_centroids, inverse_norms, loose, labels[loose],
+                                                    block_size)
+    tight[loose] = True
+    n_computed += len(loose)
+
+    bounds['centroids'] = normalized_centroids
+    # The squared distances are twice the cosine distances
+    return labels, upper ** 2 / 2, bounds, n_rows * k - n_computed
+
+
+def check_convergence(criterion, tolerance, details, previous_inertia, n_rows):
+    """
+    Returns the reason why an iteration (given by its details) converged, or None if it didn't:
+        'labels_stable': No data point changed cluster, so the centroids can't move anymore (for any criterion)
+        'centroid_shift': No centroid moved more than tolerance ('shift' criterion)
+        'inertia_change': The inertia changed by less than a tolerance fraction of its previous value
+                          ('inertia' criterion)
+        'reassigned_points': Less than a tolerance fraction of the data points changed cluster ('labels' criterion)
+    """
+    if details['changed_points'] == 0:
+        return 'labels_stable'
+    if criterion == 'shift' and details['centroid_shift'] <= tolerance:
+        return 'centroid_shift'
+    if criterion == 'inertia' and previous_inertia is not None and \
+            abs(previous_inertia - details['inertia']) <= tolerance * previous_inertia:
+        return 'inertia_change'
+    if criterion == 'labels' and details['changed_points'] <= tolerance * n_rows:
+        return 'reassigned_points'
+    return None
+
+
+def get_random_state(seed):
+    """
+    Returns a numpy random Generator from a seed (None for an unpredictable one) or an existing Generator
+    """
+    if isinstance(seed, np.random.Generator):
+        return seed
+    return np.random.default_rng(seed)
+
+
+def get_distances_to_centroid(data, centroid, inverse_norms, block_size=DEFAULT_BLOCK_SIZE):
+    """
+    Returns the cosine distance between every row in data and a single centroid
+    """
+    _, distances = assign_clusters(data, centroid[np.newaxis, :], inverse_norms, block_size)
+    return distances
+
+
+def init_random(data, k, rng):
+    """
+    Returns 'k' distinct random data points as the initial centroids
+    """
+    return get_dense_rows(data, np.sort(rng.choice(data.shape[0], size=k, replace=False)))
+
+
+def init_kmeans_plus_plus(data, k, rng, inverse_norms=None, sample_weight=None, block_size=DEFAULT_BLOCK_SIZE):
+    """
+    Returns 'k' initial centroids picked with the k-means++ strategy: after a first random data point,
+    each new centroid is a data point sampled with probability proportional to its squared cosine
+    distance to the closest centroid picked so far (times its weight, if given).
+    """
+    if inverse_norms is None:
+        inverse_norms = get_inverse_norms(data)
+    n_rows = data.shape[0]
+    weights = np.ones(n_rows) if sample_weight is None else np.asarray(sample_weight, dtype=float)
+
+    chosen = [rng.choice(n_rows, p=weights / weights.sum())]
+    closest_distances = get_distances_to_centroid(data, get_dense_rows(data, chosen)[0], inverse_norms,
+                                                  block_size)
+    for _ in range(1, k):
+        potentials = weights * closest_distances ** 2
+        if potentials.sum() > 0:
+            candidate = rng.choice(n_rows, p=potentials / potentials.sum())
+        else:
+            # Every point is already on a centroid, fall back to a uniform pick
+            candidate = rng.choice(n_rows)
+        chosen.append(candidate)
+        distances = get_distances_to_centroid(data, get_dense_rows(data, [candidate])[0], inverse_norms,
+                                              block_size)
+        np.minimum(closest_distances, distances, out=closest_distances)
+    return get_dense_rows(data, chosen)
+
+
+def init_kmeans_parallel(data, k, rng, inverse_norms=None, oversampling=None, rounds=5,
+                         block_size=DEFAULT_BLOCK_SIZE):
+    """
+    Returns 'k' initial centroids picked with the scalable k-means|| strategy: during a few rounds, every
+    data point is sampled independently with probability proportional to its squared cosine distance to
+    the candidates picked so far (about 'oversampling' points per round). The candidates are then weighted
+    by the number of data points closest to them and reduced to 'k' centroids with k-means++.
+    """
+    if inverse_norms is None:
+        inverse_norms = get_inverse_norms(data)
+    n_rows = data.shape[0]
+    if oversampling is None:
+        oversampling = 2 * k
+
+    candidates = [rng.choice(n_rows)]
+    closest_distances = get_distances_to_centroid(data, get_dense_rows(data, candidates)[0], inverse_norms,
+                                                  block_size)
+    for _ in range(rounds):
+        potentials = closest_distances ** 2
+        total_potential = potentials.sum()
+        if total_potential == 0:
+            break
+        sampled = np.flatnonzero(rng.random(n_rows) < oversampling * potentials / total_potential)
+        if len(sampled) == 0:
+            continue
+        candidates.extend(sampled.tolist())
+        _, distances = assign_clusters(data, get_dense_rows(data, sampled), inverse_norms, block_size)
+        np.minimum(closest_distances, distances, out=closest_distances)
+
+    candidates = np.unique(candidates)
+    if len(candidates) < k:
+        # Not enough distinct candidates, complete them with random data points
+        remaining = np.setdiff1d(np.arange(n_rows), candidates)
+        candidates = np.concatenate([candidates, rng.choice(remaining, size=k - len(candidates), replace=False)])
+    candidate_centroids = get_dense_rows(data, candidates)
+
+    # Weight each candidate by the number of data points closest to it, and reduce them to 'k' centroids
+    labels, _ = assign_clusters(data, candidate_centroids, inverse_norms, block_size)
+    weights = np.bincount(labels, minlength=len(candidates)) + 1e-12
+    return init_kmeans_plus_plus(candidate_centroids, k, rng, sample_weight=weights, block_size=block_size)
+
+
+def init_centroids(data, k, init, rng, inverse_norms=None, block_size=DEFAULT_BLOCK_SIZE):
+    """
+    Returns the 'k' initial centroids picked with one of the INIT_STRATEGIES
+    """
+    if data.shape[0] < k:
+        raise ValueError('The dataset has ' + str(data.shape[0]) + ' rows, at least ' + str(k) + ' are needed')
+    if init == 'random':
+        return init_random(data, k, rng)
+    if init == 'k-means++':
+        return init_kmeans_plus_plus(data, k, rng, inverse_norms, block_size=block_size)
+    if init == 'k-means||':
+        return init_kmeans_parallel(data, k, rng, inverse_norms, block_size=block_size)
+    raise ValueError('Unknown initialization strategy: ' + str(init) + ', expected one of ' +
+                     ', '.join(INIT_STRATEGIES))
+
+
+def get_process_pool(max_workers, initializer, initargs):
+    """
+    Returns a process pool whose workers are forked when possible, so the (read-only) arguments of the
+    initializer are shared with the parent process instead of being copied
+    """
+    if 'fork' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('fork')
+    else:
+        context = multiprocessing.get_context()
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=context, initializer=initializer,
+                               initargs=initargs)
+
+
+def _init_restart_worker(model, data, inverse_norms):
+    global _restart_state
+    _restart_state = (model, data, inverse_norms)
+
+
+def _run_restart(seed):
+    model, data, inverse_norms = _restart_state
+    return model._fit_run(data, inverse_norms, get_random_state(seed), report=False)
+
+
 class KMeans:
-    def __init__(self, k=3, tolerance=0.0001, max_iterations=500):
+    def __init__(self, k=3, tolerance=0.0001, max_iterations=500, block_size=DEFAULT_BLOCK_SIZE,
+                 init='random', n_init=1, random_state=None, n_jobs=1, algorithm='lloyd', callbacks=None,
+                 convergence='shift', dtype=np.float64, max_memory=None):
+        if algorithm not in ALGORITHMS:
+            raise ValueError('Unknown algorithm: ' + str(algorithm) + ', expected one of ' + ', '.join(ALGORITHMS))
+        if convergence not in CONVERGENCE_CRITERIA:
+            raise ValueError('Unknown convergence criterion: ' + str(convergence) + ', expected one of ' +
+                             ', '.join(CONVERGENCE_CRITERIA))
         self.k = k
+        # Convergence criterion (one of CONVERGENCE_CRITERIA) and its threshold: the largest centroid shift
+        # for 'shift', the relative change of the inertia for 'inertia' and the fraction of data points that
+        # changed cluster for 'labels'. The iterations always stop once no data point changes cluster.
+        self.convergence = convergence
         self.tolerance = tolerance
         self.max_iterations = max_iterations
-        self.centroids = {}
-        self.classes = {}
+        # Floating point type of the data and the centroids (float32 halves their memory), and number of rows
+        # in each block of distance computations. Given a max_memory budget (in bytes), the block size is derived
+        # from it for the data of each fit instead (see block_size_)
+        self.dtype = np.dtype(dtype)
+        self.block_size = block_size
+        self.max_memory = max_memory
+        # Initialization strategy (one of INIT_STRATEGIES, or a k x D array with the initial centroids),
+        # number of restarts (keeping the one with the lowest SSE) and processes used to run them
+        self.init = init
+        self.n_init = n_init
+        self.random_state = random_state
+        self.n_jobs = n_jobs
+        # Algorithm used to assign the data points: 'lloyd' computes every distance on every iteration,
+        # 'elkan' and 'hamerly' skip most of them with triangle inequality bounds
+        self.algorithm = algorithm
+        # Functions called as callback(model, details) after each iteration, with the details added to history_
+        # (the restarts run on other processes report their iterations once they finish)
+        self.callbacks = list(callbacks) if callbacks is not None else []
+        # Position of each centroid (k x D) and index of the assigned centroid for each data point (N)
+        self.cluster_centers_ = None
+        self.labels_ = None
+        # Number of rows of each block of distance computations on the fitted data
+        self.block_size_ = None
+        # SSE, number of iterations and per-iteration details of the kept run (wall time, assignment and
+        # update time, inertia, points that changed cluster, largest centroid shift and pruned distances),
+        # and the reason why it stopped (see check_convergence, or 'max_iterations')
+        self.inertia_ = None
+        self.n_iter_ = None
+        self.history_ = None
+        self.convergence_reason_ = None
+        # The fitted data is kept by reference (never copied) to compute the scores, along with the ID of
+        # each of its rows (their positions if no IDs were given)
+        self.data_ = None
+        self.ids_ = None
+        self._inverse_norms = None
 
-    def fit(self, data):
-        # initialize the centroids, a random sample 'k' elements in the dataset will be our initial centroids
-        data_sample = random.sample(list(data), self.k)
-        self.centroids = {}
-        for i in range(self.k):
-            self.centroids[i] = data_sample[i]
+    def _get_block_size(self, data):
+        """
+        Returns the number of rows of each block of distance computations on data, within max_memory if given
+        """
+        if self.max_memory is None:
+            return self.block_size
+        return get_block_size(data, self.k, self.max_memory)
 
-        print("Initialize fitting with " + str(self.k) + " centroids")
+    def _init_centroids(self, data, inverse_norms, rng):
+        if isinstance(self.init, str):
+            return init_centroids(data, self.k, self.init, rng, inverse_norms, self.block_size_)
+        # Start from the given centroids (e.g. those of a previously fitted model)
+        return np.array(self.init, dtype=self.dtype)
 
-        # begin iterations
-        for i in range(self.max_iterations):
-            print("Beginning iteration " + str(i) + " of the K-Means algorithm...")
-            self.classes = {}
-            for i in range(self.k):
-                self.classes[i] = []
+    def _report_iteration(self, details):
+        """
+        Logs the details of an iteration and passes them on to the callbacks
+        """
+        logging.getLogger(__name__).debug(
+            'Iteration ' + str(details['iteration']) + ': ' +
+            ', '.join(key + '=' + str(value) for key, value in details.items() if key != 'iteration'))
+        for callback in self.callbacks:
+            callback(self, details)
 
-            # find the cosine distance between the point and each centroid and pick the closest one
-            for features in data:
-                classification = self.pred(features)
-                self.classes[classification].append(features)
+    def _fit_run(self, data, inverse_norms, rng, restart=0, report=True):
+        """
+        Runs the algorithm once from a new set of initial centroids, and returns the final centroids,
+        the labels of the data points, the number of iterations, the details of each iteration
+        (which are also reported as they happen, unless report is False) and the reason why it stopped
+        """
+        logger = logging.getLogger(__name__)
+        centroids = self._init_centroids(data, inverse_norms, rng)
+        previous = np.empty_like(centroids)
+        labels = None
+        bounds = None
+        history = []
 
-            previous = dict(self.centroids)
+        # begin iterations
+        for iteration in range(self.max_iterations):
+            started = time.perf_counter()
+            previous_labels = labels.copy() if labels is not None else None
+
+            # find the cosine distance between every point and each centroid and pick the closest one
+            if self.algorithm == 'lloyd':
+                labels, distances = assign_clusters(data, centroids, inverse_norms, self.block_size_)
+                n_pruned = 0
+            else:
+                labels, distances, bounds, n_pruned = assign_clusters_bounded(
+                    self.algorithm, data, centroids, inverse_norms, bounds, self.block_size_)
+            assigned = time.perf_counter()
 
             # average the cluster data points to re-calculate the centroids
-            for classification in self.classes:
-                self.centroids[classification] = np.average(self.classes[classification], axis=0)
+            previous[:] = centroids
+            update_centroids(centroids, data, labels)
+            updated = time.perf_counter()
 
-            is_optimal = True
+            details = {
+                'restart': restart,
+                'iteration': iteration,
+                'seconds': updated - started,
+                'assignment_seconds': assigned - started,
+                'update_seconds': updated - assigned,
+                'inertia': float(np.sum(distances ** 2)),
+                'changed_points': int(data.shape[0] if previous_labels is None
+                                      else np.count_nonzero(labels != previous_labels)),
+                'centroid_shift': float(np.max(np.linalg.norm(centroids - previous, axis=1))),
+                'pruned_distances': int(n_pruned),
+            }
+            history.append(details)
+            if report:
+                self._report_iteration(details)
 
-            for centroid in self.centroids:
+            # If the centroids converged according to the criterion, break out of the loop
+            reason = check_convergence(self.convergence, self.tolerance, details,
+                                       history[-2]['inertia'] if len(history) > 1 else None, data.shape[0])
+            if reason is not None:
+                logger.info('Optimal centroids have been found after ' + str(iteration) + ' iterations (' +
+                            reason + '), stopping...')
+                return centroids, labels, iteration + 1, history, reason
+        return centroids, labels, self.max_iterations, history, 'max_iterations'
 
-                original_centroid = previous[centroid]
-                curr = self.centroids[centroid]
+    def _run_restarts(self, data, inverse_norms, seeds):
+        """
+        Returns the results of one run for each seed, spread across n_jobs processes
+        """
+        if self.n_jobs == 1 or len(seeds) == 1:
+            return [self._fit_run(data, inverse_norms, get_random_state(seed), restart)
+                    for restart, seed in enumerate(seeds)]
+        # The workers only need the parameters of the model, not the results of a previous fit, and their
+        # iterations are reported here once each restart finishes
+        model = copy.copy(self)
+        model.data_ = model.ids_ = model.labels_ = model.cluster_centers_ = model._inverse_norms = None
+        model.callbacks = []
+        results = []
+        with get_process_pool(self.n_jobs, _init_restart_worker, (model, data, inverse_norms)) as executor:
+            for restart, result in enumerate(executor.map(_run_restart, seeds)):
+                for details in result[3]:
+                    details['restart'] = restart
+                    self._report_iteration(details)
+                results.append(result)
+        return results
 
-                if np.sum((curr - original_centroid) / original_centroid * 100.0) > self.tolerance:
-                    is_optimal = False
+    def fit(self, data, ids=None):
+        data = as_data_matrix(data, self.dtype)
+        ids = get_row_ids(data, ids)
+        rng = get_random_state(self.random_state)
+        self.block_size_ = self._get_block_size(data)
 
-            # If the results change their positions less than our tolerance value, break out of the loop
-            if is_optimal:
-                print("Optimal centroids have been found after " + str(i) + " iterations, stopping...")
-                break
+        logging.getLogger(__name__).info('Initialize fitting with ' + str(self.k) + ' centroids')
+
+        # The norms of the data points never change, so they are only computed once
+        inverse_norms = get_inverse_norms(data)
+
+        # Restarts only make sense when the initial centroids are picked at random
+        n_init = self.n_init if isinstance(self.init, str) else 1
+        seeds = rng.integers(np.iinfo(np.int32).max, size=n_init)
+
+        best_sse = None
+        for centroids, labels, n_iter, history, reason in self._run_restarts(data, inverse_norms, seeds):
+            sse_score = float(np.sum(get_point_distances(data, centroids, labels, inverse_norms,
+                                                         self.block_size_) ** 2))
+            if best_sse is None or sse_score < best_sse:
+                best_sse = sse_score
+                self.cluster_centers_ = centroids
+                self.labels_ = labels
+                self.n_iter_ = n_iter
+                self.history_ = history
+                self.convergence_reason_ = reason
+
+        self.inertia_ = best_sse
+        self.data_ = data
+        self.ids_ = ids
+        self._inverse_norms = inverse_norms
 
     def pred(self, data):
         """Predicts the assigned cluster for the given data point"""
-        distances = [get_cosine_distance(data, self.centroids[centroid]) for centroid in self.centroids]
-        classification = distances.index(min(distances))
-        return classification
+        return int(self.predict(np.reshape(data, (1, -1)))[0])
+
+    def predict(self, data):
+        """Predicts the assigned cluster for every row of the given data matrix"""
+        data = as_data_matrix(data, self.dtype)
+        labels, _ = assign_clusters(data, self.cluster_centers_, block_size=self._get_block_size(data))
+        return labels
 
-    def get_clusters(self, vector_dict):
+    def get_clusters(self):
         """
-        Given a dictionary with the IDs of the vectors, returns the IDs classified in the clusters.
+        Returns the IDs of the data points classified in each cluster.
         Used to generate the results report, given that it requires writing the user story Id instead
         of the features vector.
         """
-        clusters = {}
-        for i in range(self.k):
-            clusters[i] = []
-            # Add the vectors from self.classes to clusters, with the help of vector_dict
-            for vector in self.classes[i]:
-                vector_id = vector_dict[tuple(vector)]
-                clusters[i].append(vector_id)
-        return clusters
+        # Sorting the row positions by label groups the rows of each cluster, keeping their order
+        order = np.argsort(self.labels_, kind='stable')
+        counts = np.bincount(self.labels_, minlength=self.k)
+        cluster_ids = np.split(self.ids_[order], np.cumsum(counts)[:-1])
+        return {i: cluster_ids[i].tolist() for i in range(self.k)}
 
     def get_sse_score(self):
         """
         Returns the Sum of Squared Error (SSE) of the clusters.
         """
-        sse_score = 0
-        # Iterate through each cluster
-        for i in range(self.k):
-            # Inside each cluster, get the distance of each vector with the centroid
-            for vector in self.classes[i]:
-                # Calculate distance here
-                distance = get_cosine_distance(vector, self.centroids[i])
-                pow_distance = distance**2
-                sse_score += pow_distance
-        return sse_score
+        # Get the distance of each vector with the centroid of its cluster
+        distances = get_point_distances(self.data_, self.cluster_centers_, self.labels_,
+                                        self._inverse_norms, self.block_size_)
+        return float(np.sum(distances ** 2))
 
-    def get_msc_avg(self):
+    def get_msc_avg(self, sample_size=None, random_state=None):
         """
         Returns the Mean Silhouette Coefficient (MSC) of the clusters.
+        Given a sample_size, only the coefficients of that many randomly chosen data points (picked with
+        random_state as the seed) are averaged, as an approximation of the MSC for very large datasets.
         """
-        coefficients = []
-        # Iterate through each cluster
-        for i in range(self.k):
-            # Inside each cluster, get the distance of each vector with the centroid
-            for vector in self.classes[i]:
-                a_values = []
-                # Iterate through the points inside the current cluster
-                for point in self.classes[i]:
-                    distance = get_cosine_distance(vector, point)
-                    a_values.append(distance)
-                avg_a = mean(a_values)
-
-                # Iterate through the points in the other clusters
-                remaining_clusters = [key for key, value in self.classes.items() if key != i]
-                avg_b_list = []
-                for key in remaining_clusters:
-                    b_values = []
-                    for point in self.classes[key]:
-                        distance = get_cosine_distance(vector, point)
-                        b_values.append(distance)
-                    avg_b = mean(b_values)
-                    avg_b_list.append(avg_b)
-                min_b = min(avg_b_list)
-
-                # Calculate the silhouette coefficient for that point
-                s_point = (min_b - avg_a) / float(max(avg_a, min_b))
-                coefficients.append(s_point)
+        n_rows = self.data_.shape[0]
+        cluster_sums = get_normalized_cluster_sums(self.data_, self.labels_, self.k, self._inverse_norms)
+        counts = np.bincount(self.labels_, minlength=self.k)
 
+        if sample_size is not None and sample_size < n_rows:
+            rng = np.random.default_rng(random_state)
+            points = np.sort(rng.choice(n_rows, size=sample_size, replace=False))
+        else:
+            points = np.arange(n_rows)
+
+        coefficients = get_silhouette_coefficients(self.data_, self.labels_, cluster_sums, counts,
+                                                   self._inverse_norms, points, self.block_size_)
         # Get the average of all the coefficients
-        msc_score_avg = mean(coefficients)
-        return msc_score_avg
+        return float(np.mean(coefficients))
+
+
+class MiniBatchKMeans(KMeans):
+    """
+    Variant of KMeans that updates the centroids from fixed-size random batches of data points instead of
+    full passes over the dataset, so each iteration takes the same time regardless of the dataset size.
+    Every centroid moves towards the average of its points in the batch with a learning rate of
+    (points in the batch) / (points seen so far by that centroid), until no centroid moves more than the
+    tolerance (so the convergence criterion is always 'shift'). It can also be trained incrementally,
+    one chunk of data at a time, with partial_fit.
+    """
+
+    def __init__(self, k=3, batch_size=1024, tolerance=0.0001, max_iterations=100,
+                 block_size=DEFAULT_BLOCK_SIZE, init='random', n_init=1, random_state=None, n_jobs=1,
+                 callbacks=None, dtype=np.float64, max_memory=None):
+        super().__init__(k=k, tolerance=tolerance, max_iterations=max_iterations, block_size=block_size,
+                         init=init, n_init=n_init, random_state=random_state, n_jobs=n_jobs, algorithm='lloyd',
+                         callbacks=callbacks, dtype=dtype, max_memory=max_memory)
+        self.batch_size = batch_size
+        # Number of data points that have been used to update each centroid so far
+        self.counts_ = None
+
+    def _update_batch(self, centroids, counts, batch):
+        """
+        Moves the centroids towards the average of the batch points assigned to them, and returns the
+        largest distance moved by a centroid along with the inertia of the batch
+        """
+        labels, distances = assign_clusters(batch, centroids, block_size=self.block_size_)
+        batch_counts = np.bincount(labels, minlength=self.k)
+        batch_sums = get_membership_matrix(labels, self.k) @ batch
+        if sparse.issparse(batch_sums):
+            batch_sums = batch_sums.toarray()
+
+        updated = batch_counts > 0
+        counts += batch_counts
+        learning_rates = batch_counts[updated] / counts[updated]
+        batch_means = np.asarray(batch_sums)[updated] / batch_counts[updated, np.newaxis]
+        shifts = learning_rates[:, np.newaxis] * (batch_means - centroids[updated])
+        centroids[updated] += shifts
+        max_shift = float(np.max(np.linalg.norm(shifts, axis=1))) if np.any(updated) else 0.0
+        return max_shift, float(np.sum(distances ** 2))
+
+    def _fit_run(self, data, inverse_norms, rng, restart=0, report=True):
+        n_rows = data.shape[0]
+        centroids = self._init_centroids(data, inverse_norms, rng)
+        counts = np.zeros(self.k, dtype=np.int64)
+        history = []
+
+        for iteration in range(self.max_iterations):
+            started = time.perf_counter()
+            batch_rows = np.sort(rng.choice(n_rows, size=min(self.batch_size, n_rows), replace=False))
+            max_shift, batch_inertia = self._update_batch(centroids, counts, data[batch_rows])
+            details = {'restart': restart, 'iteration': iteration, 'seconds': time.perf_counter() - started,
+                       'batch_size': len(batch_rows), 'inertia': batch_inertia, 'centroid_shift': max_shift,
+                       'pruned_distances': 0}
+            history.append(details)
+            if report:
+                self._report_iteration(details)
+
+            # If no centroid moved more than our tolerance value, break out of the loop
+            if max_shift < self.tolerance:
+                logging.getLogger(__name__).info('Optimal centroids have been found after ' + str(iteration) +
+                                                 ' iterations, stopping...')
+                reason = 'centroid_shift'
+                break
+        else:
+            reason = 'max_iterations'
+
+        # Assign every data point to its closest centroid, so the scores can be computed on the data
+        labels, _ = assign_clusters(data, centroids, inverse_norms, self.block_size_)
+        return centroids, labels, len(history), history, reason
+
+    def fit(self, data, ids=None):
+        super().fit(data, ids)
+        # From now on, each centroid represents the data points assigned to it
+        self.counts_ = np.bincount(self.labels_, minlength=self.k).astype(np.int64)
+
+    def partial_fit(self, data, ids=None):
+        """
+        Updates the centroids with a single chunk of data points. The labels (and the scores) of the model
+        refer to the last chunk given.
+        """
+        data = as_data_matrix(data, self.dtype)
+        ids = get_row_ids(data, ids)
+        self.block_size_ = self._get_block_size(data)
+        inverse_norms = get_inverse_norms(data)
+        if self.cluster_centers_ is None:
+            rng = get_random_state(self.random_state)
+            self.cluster_centers_ = self._init_centroids(data, inverse_norms, rng)
+            self.counts_ = np.zeros(self.k, dtype=np.int64)
+        self._update_batch(self.cluster_centers_, self.counts_, data)
+
+        self.labels_, _ = assign_clusters(data, self.cluster_centers_, inverse_norms, self.block_size_)
+        self.data_ = data
+        self.ids_ = ids
+        self._inverse_norms = inverse_norms
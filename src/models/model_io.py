@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import os
+import numpy as np
+from src.data.make_dataset import TEXT_COLUMNS
+from src.features.build_features import transform
+from src.features.feature_store import write_folder
+from src.models.k_means import assign_clusters
+
+# String constants
+CONFIG_FILENAME = 'config.json'
+CENTROIDS_FILENAME = 'centroids.npy'
+IDFS_FILENAME = 'idfs.npy'
+VOCABULARY_FILENAME = 'vocabulary.json'
+
+
+def is_saved_model(path):
+    """
+    Returns True if the given path is a folder created by ClusteringModel.save
+    """
+    return os.path.isfile(os.path.join(path, CONFIG_FILENAME))
+
+
+class ClusteringModel:
+    """
+    Everything needed to assign new raw user stories to the clusters of a trained model: the centroids, the
+    vocabulary and idfs of the TF-IDF scores, and the settings of the pre-processing steps.
+    """
+
+    def __init__(self, centroids, vocabulary, idfs, config=None):
+        self.centroids = centroids
+        self.vocabulary = vocabulary
+        self.idfs = idfs
+        self.config = config if config is not None else {}
+        self.vocabulary_index = {word: column for column, word in enumerate(vocabulary)}
+
+    def save(self, folder):
+        """
+        Saves the model on the given folder as binary .npy arrays, with .json files for the vocabulary and
+        the configuration
+        """
+        with write_folder(folder, CONFIG_FILENAME) as config:
+            np.save(os.path.join(folder, CENTROIDS_FILENAME), np.asarray(self.centroids, dtype=float))
+            np.save(os.path.join(folder, IDFS_FILENAME), np.asarray(self.idfs, dtype=float))
+            with open(os.path.join(folder, VOCABULARY_FILENAME), 'w', encoding='utf-8') as file:
+                json.dump(list(self.vocabulary), file)
+            config.update(self.config, k=int(self.centroids.shape[0]))
+
+    @classmethod
+    def load(cls, folder, mmap=True):
+        """
+        Loads a model saved on the given folder. By default the arrays are memory-mapped (read-only).
+        """
+        mmap_mode = 'r' if mmap else None
+        with open(os.path.join(folder, CONFIG_FILENAME), encoding='utf-8') as file:
+            config = json.load(file)
+        with open(os.path.join(folder, VOCABULARY_FILENAME), encoding='utf-8') as file:
+            vocabulary = json.load(file)
+        centroids = np.load(os.path.join(folder, CENTROIDS_FILENAME), mmap_mode=mmap_mode)
+        idfs = np.load(os.path.join(folder, IDFS_FILENAME), mmap_mode=mmap_mode)
+        return cls(centroids, vocabulary, idfs, config)
+
+    def check_preprocessing_config(self):
+        """
+        Logs a warning if the pre-processing steps changed since the model was trained
+        """
+        from src.data.make_dataset import get_preprocessing_config
+        current_config = get_preprocessing_config()
+        for key, value in current_config.items():
+            if key in self.config and self.config[key] != value:
+                logging.getLogger(__name__).warning('The pre-processing setting ' + key + ' changed since the '
+                                                    'model was trained: ' + str(self.config[key]) + ' -> ' +
+                                                    str(value))
+
+    def transform(self, dataset):
+        """
+        Returns the TF-IDF scores of the pre-processed user stories of the dataset over the model vocabulary
+        """
+        return transform(dataset, self.vocabulary_index, self.idfs)
+
+    def assign(self, dataset):
+        """
+        Returns the cluster of each pre-processed user story of the dataset, along with its cosine distance
+        to the centroid of that cluster
+        """
+        return assign_clusters(self.transform(dataset), np.asarray(self.centroids))
+
+    def predict(self, dataset):
+        """
+        Returns the cluster of each pre-processed user story of the dataset
+        """
+        labels, _ = self.assign(dataset)
+        return labels
+
+    def predict_raw(self, dataset, jobs=1, executor=None):
+        """
+        Pre-processes the raw user stories of the dataset (like make_dataset does) and returns their clusters
+        """
+        # The NLTK pre-processing is only imported when it is needed
+        from src.data.make_dataset import preprocess_dataset
+        columns = self.config.get('text_columns', TEXT_COLUMNS)
+        return self.predict(preprocess_dataset(dataset, columns, jobs=jobs, executor=executor))
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+import click
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from src.models.model_io import ClusteringModel
+
+
+def iter_raw_batches(file, batch_size):
+    """
+    Yields batches of batch_size raw user stories from an open .csv file with the columns of the raw dataset
+    """
+    import pandas as pd
+    yield from pd.read_csv(file, usecols=['id', 'role', 'feature', 'benefit'], chunksize=batch_size)
+
+
+@click.command()
+@click.argument('model_folder', type=click.Path(exists=True))
+@click.argument('input_file', type=click.File('r'), default='-')
+@click.option('--output', 'output_file', type=click.File('w'), default='-',
+              help='File where the cluster of each user story is written. Defaults to the standard output.')
+@click.option('--batch-size', default=1000, help='Number of user stories pre-processed and classified at once.')
+@click.option('--jobs', default=1, help='Number of worker processes for the pre-processing.')
+def main(model_folder, input_file, output_file, batch_size, jobs):
+    """
+    Assigns the raw user stories of input_file (a .csv file with the columns of the raw dataset, read from
+    the standard input by default) to the clusters of the model saved on model_folder by train_model.
+    Writes an id,cluster line for each user story.
+    """
+    import pandas as pd
+    from src.data.make_dataset import check_nltk_resources
+    logger = logging.getLogger(__name__)
+    check_nltk_resources()
+    model = ClusteringModel.load(model_folder)
+    model.check_preprocessing_config()
+    logger.info('Loaded model ' + model_folder + ' with ' + str(model.centroids.shape[0]) + ' clusters')
+
+    n_rows = 0
+    executor = ProcessPoolExecutor(max_workers=jobs) if jobs != 1 else None
+    try:
+        for position, batch in enumerate(iter_raw_batches(input_file, batch_size)):
+            labels = model.predict_raw(batch, executor=executor)
+            pd.DataFrame({'id': batch['id'].values, 'cluster': labels}).to_csv(output_file, index=False,
+                                                                              header=(position == 0))
+            output_file.flush()
+            n_rows += len(batch)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    logger.info('Classified ' + str(n_rows) + ' user stories')
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    main()
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+import cProfile
+import json
+import pstats
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+# Number of functions (by cumulative time) and allocation sites (by size) kept in a profile
+PROFILE_TOP_ENTRIES = 50
+
+
+def get_cpu_profile(profiler, top=PROFILE_TOP_ENTRIES):
+    """
+    Returns the functions of a cProfile run that took the most cumulative time, as a list of dictionaries
+    """
+    stats = pstats.Stats(profiler)
+    entries = []
+    for (filename, line, function), (primitive_calls, calls, total_time, cumulative_time, _) in \
+            stats.stats.items():
+        entries.append({'function': filename + ':' + str(line) + '(' + function + ')', 'calls': calls,
+                        'primitive_calls': primitive_calls, 'total_seconds': total_time,
+                        'cumulative_seconds': cumulative_time})
+    entries.sort(key=lambda entry: entry['cumulative_seconds'], reverse=True)
+    return entries[:top]
+
+
+def get_memory_profile(snapshot, top=PROFILE_TOP_ENTRIES):
+    """
+    Returns the lines of a tracemalloc snapshot that allocated the most memory, as a list of dictionaries
+    """
+    return [{'location': str(statistic.traceback), 'size_bytes': statistic.size, 'count': statistic.count}
+            for statistic in snapshot.statistics('lineno')[:top]]
+
+
+@contextmanager
+def profile_run(filepath, cpu=True, memory=False):
+    """
+    Profiles the code run inside the context with cProfile (if cpu is set) and tracemalloc (if memory is set),
+    and dumps the results as JSON on filepath. The context yields a dictionary where the code can add more
+    results (e.g. the per-iteration history of a model), which are saved along with the profile.
+    """
+    report = {}
+    profiler = cProfile.Profile() if cpu else None
+    if memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield report
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        profile = {'wall_seconds': time.perf_counter() - started}
+        if profiler is not None:
+            profile['cpu'] = get_cpu_profile(profiler)
+        if memory:
+            current, peak = tracemalloc.get_traced_memory()
+            profile['memory'] = {'current_bytes': current, 'peak_bytes': peak,
+                                 'top_allocations': get_memory_profile(tracemalloc.take_snapshot())}
+            tracemalloc.stop()
+        profile.update(report)
+        with open(filepath, 'w', encoding='utf-8') as file:
+            json.dump(profile, file, indent=2, default=str)
@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import click
+import json
+import logging
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from src.data.make_dataset import TEXT_COLUMNS, check_nltk_resources, preprocess_batch
+from src.models.model_io import ClusteringModel
+
+# Number of most recent requests whose latency is kept to compute the percentiles
+LATENCY_WINDOW = 10000
+
+# Period (in seconds) over which the recent throughput is measured
+THROUGHPUT_WINDOW = 10.0
+
+# Maximum size of a request body, in bytes
+MAX_BODY_SIZE = 1024 * 1024
+
+HTTP_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+                413: 'Payload Too Large', 500: 'Internal Server Error'}
+
+
+class ServiceMetrics:
+    """
+    Counters of the requests served, with the latency of the most recent ones
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.requests = 0
+        self.stories = 0
+        self.batches = 0
+        self.errors = 0
+        # (completion time, latency) of the most recent requests
+        self.recent = deque(maxlen=LATENCY_WINDOW)
+
+    def record_request(self, started, n_stories):
+        finished = time.perf_counter()
+        self.requests += 1
+        self.stories += n_stories
+        self.recent.append((finished, finished - started))
+
+    def record_batch(self):
+        self.batches += 1
+
+    def to_dict(self):
+        now = time.perf_counter()
+        uptime = now - self.started
+        latencies = np.array([latency for _, latency in self.recent]) * 1000.0
+        recent_requests = sum(1 for finished, _ in self.recent if now - finished <= THROUGHPUT_WINDOW)
+        return {
+            'uptime_seconds': uptime,
+            'requests': self.requests,
+            'stories': self.stories,
+            'errors': self.errors,
+            'batches': self.batches,
+            'average_batch_size': self.stories / self.batches if self.batches else None,
+            'throughput_stories_per_second': self.stories / uptime if uptime > 0 else None,
+            'recent_requests_per_second': recent_requests / min(THROUGHPUT_WINDOW, uptime) if uptime > 0 else None,
+            'latency_p50_ms': float(np.percentile(latencies, 50)) if len(latencies) else None,
+            'latency_p99_ms': float(np.percentile(latencies, 99)) if len(latencies) else None,
+        }
+
+
+class MicroBatcher:
+    """
+    Coalesces the user stories of concurrent requests into batches of up to max_batch_size stories, waiting
+    at most max_wait seconds for a batch to fill. Each batch is pre-processed on the worker pool and then
+    assigned to the clusters at once, with a single matrix product.
+    """
+
+    def __init__(self, model, executor, metrics, max_batch_size=64, max_wait=0.005, max_pending_batches=4):
+        self.model = model
+        self.executor = executor
+        self.metrics = metrics
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.columns = model.config.get('text_columns', TEXT_COLUMNS)
+        self._queue = asyncio.Queue()
+        # Limits the number of batches being pre-processed at the same time
+        self._pending = asyncio.Semaphore(max_pending_batches)
+        # The event loop only keeps weak references to the tasks, so those of the batches in flight are kept here
+        self._tasks = set()
+
+    async def submit(self, story):
+        """
+        Queues a user story (a dictionary with its text columns) and returns its (cluster, distance)
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((story, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._pending.acquire()
+            items = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(items) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    items.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            task = loop.create_task(self._process(items))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _process(self, items):
+        # pandas is only needed for the DataFrame of the batch, so the service starts without loading it
+        import pandas as pd
+        loop = asyncio.get_running_loop()
+        try:
+            # Each text column of the batch is pre-processed on a different worker
+            preprocessed = await asyncio.gather(*(
+                loop.run_in_executor(self.executor, preprocess_batch,
+                                     [str(story.get(column, '')) for story, _ in items])
+                for column in self.columns))
+            labels, distances = self.model.assign(pd.DataFrame(dict(zip(self.columns, preprocessed))))
+            self.metrics.record_batch()
+            for (_, future), label, distance in zip(items, labels, distances):
+                if not future.done():
+                    future.set_result((int(label), float(distance)))
+        except Exception as error:
+            for _, future in items:
+                if not future.done():
+                    future.set_exception(error)
+        finally:
+            self._pending.release()
+
+
+def parse_story(story):
+    """
+    Returns the text columns of a user story given as a JSON object. A single 'text' field can be given
+    instead of the 'role', 'feature' and 'benefit' columns.
+    """
+    if not isinstance(story, dict):
+        raise ValueError('Each user story must be a JSON object')
+    if 'text' in story:
+        return {'feature': story['text']}
+    if not any(column in story for column in TEXT_COLUMNS):
+        raise ValueError('Each user story needs a text field, or the ' + ', '.join(TEXT_COLUMNS) + ' fields')
+    return {column: story[column] for column in TEXT_COLUMNS if column in story}
+
+
+class ClusteringService:
+    """
+    HTTP/1.1 service (on top of asyncio streams) with the following endpoints:
+        POST /predict: Receives a user story (or a list of them) as JSON and returns its cluster and distance
+        GET /metrics: Returns the latency and throughput counters
+        GET /health: Returns a 200 response once the service is running
+    """
+
+    def __init__(self, batcher, metrics):
+        self.batcher = batcher
+        self.metrics = metrics
+
+    async def predict(self, body):
+        payload = json.loads(body)
+        stories = payload if isinstance(payload, list) else [payload]
+        # Every story is validated before any is submitted, so an invalid one doesn't leave the others pending
+        columns = [parse_story(story) for story in stories]
+        results = await asyncio.gather(*(self.batcher.submit(story_columns) for story_columns in columns))
+        responses = []
+        for story, (cluster, distance) in zip(stories, results):
+            response = {'cluster': cluster, 'distance': distance}
+            if 'id' in story:
+                response['id'] = story['id']
+            responses.append(response)
+        return responses if isinstance(payload, list) else responses[0]
+
+    async def route(self, method, path, body):
+        """
+        Returns the status and the JSON response of a request
+        """
+        if path == '/predict':
+            if method != 'POST':
+                return 405, {'error': 'Use POST to classify user stories'}
+            started = time.perf_counter()
+            try:
+                response = await self.predict(body)
+            except ValueError as error:
+                self.metrics.errors += 1
+                return 400, {'error': str(error)}
+            self.metrics.record_request(started, len(response) if isinstance(response, list) else 1)
+            return 200, response
+        if path == '/metrics' and method == 'GET':
+            return 200, self.metrics.to_dict()
+        if path == '/health' and method == 'GET':
+            return 200, {'status': 'ok'}
+        return 404, {'error': 'Unknown endpoint ' + path}
+
+    async def handle_connection(self, reader, writer):
+        """
+        Serves the requests of a connection, keeping it open between them unless the client closes it
+        """
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                try:
+                    method, path, version = request_line.decode('latin-1').split()
+                    keep_alive = keep_alive and (version == 'HTTP/1.1' or
+                                                 headers.get('connection', '').lower() == 'keep-alive')
+                    length = int(headers.get('content-length', 0))
+                    if length > MAX_BODY_SIZE:
+                        status, response = 413, {'error': 'The request body is too large'}
+                        keep_alive = False
+                    else:
+                        body = await reader.readexactly(length) if length else b''
+                        status, response = await self.route(method, path.split('?', 1)[0], body)
+                except ValueError as error:
+                    status, response = 400, {'error': 'Malformed request: ' + str(error)}
+                    keep_alive = False
+                except Exception:
+                    logging.getLogger(__name__).exception('Error while serving a request')
+                    self.metrics.errors += 1
+                    status, response = 500, {'error': 'Internal server error'}
+
+                content = json.dumps(response).encode('utf-8')
+                writer.write(('HTTP/1.1 ' + str(status) + ' ' + HTTP_REASONS[status] + '\r\n' +
+                              'Content-Type: application/json\r\n' +
+                              'Content-Length: ' + str(len(content)) + '\r\n' +
+                              'Connection: ' + ('keep-alive' if keep_alive else 'close') + '\r\n\r\n')
+                             .encode('latin-1') + content)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+async def serve(model, host, port, max_batch_size, max_wait, jobs):
+    logger = logging.getLogger(__name__)
+    metrics = ServiceMetrics()
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        # Load the NLTK resources on every worker before the first request arrives
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(loop.run_in_executor(executor, preprocess_batch, ['warm up'])
+                               for _ in range(jobs)))
+
+        batcher = MicroBatcher(model, executor, metrics, max_batch_size, max_wait, max_pending_batches=2 * jobs)
+        service = ClusteringService(batcher, metrics)
+        batcher_task = loop.create_task(batcher.run())
+        server = await asyncio.start_server(service.handle_connection, host, port)
+        logger.info('Serving the clusters on http://' + host + ':' + str(port))
+        async with server:
+            server_task = loop.create_task(server.serve_forever())
+            try:
+                # No request can be answered without the batcher, so the service stops if it fails
+                await asyncio.wait([server_task, batcher_task], return_when=asyncio.FIRST_COMPLETED)
+                if batcher_task.done():
+                    logger.error('The batcher stopped, shutting down the service')
+                    batcher_task.result()
+                    raise RuntimeError('The batcher stopped unexpectedly')
+                server_task.result()
+            finally:
+                server_task.cancel()
+                batcher_task.cancel()
+
+
+@click.command()
+@click.argument('model_folder', type=click.Path(exists=True))
+@click.option('--host', default='127.0.0.1', help='Address the service listens on.')
+@click.option('--port', default=8000, help='Port the service listens on.')
+@click.option('--max-batch-size', default=64, help='Maximum number of user stories classified in a batch.')
+@click.option('--max-wait-ms', default=5.0, help='Maximum time a user story waits for its batch to fill.')
+@click.option('--jobs', default=None, type=int,
+              help='Number of worker processes for the pre-processing. Defaults to the number of CPUs.')
+def main(model_folder, host, port, max_batch_size, max_wait_ms, jobs):
+    """
+    Serves the clusters of the model saved on model_folder by train_model over HTTP
+    """
+    logger = logging.getLogger(__name__)
+    check_nltk_resources()
+    model = ClusteringModel.load(model_folder)
+    model.check_preprocessing_config()
+    logger.info('Loaded model ' + model_folder + ' with ' + str(model.centroids.shape[0]) + ' clusters')
+    try:
+        asyncio.run(serve(model, host, port, max_batch_size, max_wait_ms / 1000.0, jobs or os.cpu_count()))
+    except KeyboardInterrupt:
+        logger.info('Stopped the service')
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    main()
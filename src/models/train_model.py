@@ -1,14 +1,38 @@
 # -*- coding: utf-8 -*-
 import click
 import logging
-import pandas as pd
-from k_means import KMeans
+import os
 import os.path
+import tempfile
+from contextlib import contextmanager
+import numpy as np
+from scipy import sparse
+from src.features.feature_store import is_feature_store, iter_feature_chunks, load_features, load_idfs, save_features
+from src.memory import DTYPES, MemorySize, get_rows_per_block
+from src.models.k_means import (ALGORITHMS, CONVERGENCE_CRITERIA, INIT_STRATEGIES, KMeans, MiniBatchKMeans,
+                                get_inverse_norms, get_normalized_cluster_sums, get_point_distances,
+                                get_process_pool, get_silhouette_coefficients)
+from src.models.model_io import ClusteringModel
+from src.models.profiling import profile_run
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - file locking is only available on POSIX systems
+    fcntl = None
 
 # String constants
 PLOT_TABLE_FILENAME = 'k-means-plot-results.csv'
 MODEL_REPORT_FILENAME = 'k-means-results.txt'
 
+# Number of rows of a .csv table of scores parsed at a time, unless a memory budget sets it
+CSV_CHUNK_SIZE = 1000
+
+# Number of copies of each parsed row of a .csv table held at a time (the DataFrame and its dense array)
+CSV_ROW_COPIES = 2
+
+# Features loaded by each worker process of a K sweep (matrix and user story IDs)
+_sweep_features = None
+
 
 def generate_report(clusters, sse_score, msc_score, filepath):
     """
@@ -29,6 +53,8 @@ def generate_report(clusters, sse_score, msc_score, filepath):
 
 
 def create_plot_results_table():
+    # pandas is only loaded for the .csv tables, training from a feature store doesn't need it
+    import pandas as pd
     data = []
     k_range = range(2,11)
     for i in k_range:
@@ -40,77 +66,419 @@ def create_plot_results_table():
 
 def update_plot_results_table(df, tuple_k_scores):
     k_size = tuple_k_scores[0]
-    df.loc[[k_size], ['SSE Score']] = tuple_k_scores[1]
-    df.loc[[k_size], ['MSC Score']] = tuple_k_scores[2]
-    return df
+    df.loc[k_size, 'SSE Score'] = tuple_k_scores[1]
+    df.loc[k_size, 'MSC Score'] = tuple_k_scores[2]
+    return df.sort_index()
 
 
-def generate_vector_dict(dataset):
+@contextmanager
+def plot_results_table_lock(output_folder):
     """
-    Generates a dictionary that uses the user story vectors (tuples) as keys, with the user story IDs as values.
+    Holds an exclusive lock on the results table of the output folder, so runs launched concurrently
+    don't overwrite each other's scores. The lock is taken on the folder itself, so no lock file is left in it.
     """
-    vector_dict = {}
-    dataset_list = dataset.values.tolist()
-
-    for row in dataset_list:
-        id = row[0]
-        vector = row[1:]
-        vector_dict[tuple(vector)] = id
-    return vector_dict
+    if fcntl is None:
+        yield
+        return
+    folder_fd = os.open(output_folder or '.', os.O_RDONLY)
+    try:
+        fcntl.flock(folder_fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(folder_fd, fcntl.LOCK_UN)
+    finally:
+        os.close(folder_fd)
 
 
-@click.command()
-@click.argument('input_filepath', type=click.Path(exists=True))
-@click.argument('output_folder', type=click.Path())
-@click.option('--k', default=3, help='Number of centroids.')
-def main(input_filepath, output_folder, k):
+def get_file_mode(filepath):
     """
-    Receives the location of the tf-idf scores as a
-    command-line Path argument.
+    Returns the permissions of an existing file, or those a new file gets from the umask otherwise
     """
-    logger = logging.getLogger(__name__)
-    logger.info('Training the K-Means clustering algorithm based on the TF-IDF scores')
+    if os.path.isfile(filepath):
+        return os.stat(filepath).st_mode & 0o777
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
 
-    # Get the models/tf-idf-scores.csv file
-    dataset = pd.read_csv(input_filepath)
-    logger.info('Loaded data file ' + input_filepath + ' with ' + str(len(dataset)) + ' rows')
+def save_plot_results(output_folder, k_scores_list):
+    """
+    Generates / Updates the results table for future plots with a list of (K, SSE, MSC) tuples.
+    The read-modify-write happens under a file lock, and the new table atomically replaces the old one.
+    """
+    import pandas as pd
+    filepath = output_folder + PLOT_TABLE_FILENAME
+    with plot_results_table_lock(output_folder):
+        if os.path.isfile(filepath):
+            # Update the existing file
+            k_means_results = pd.read_csv(filepath)
+            k_means_results.set_index('K Size', inplace=True)
+        else:
+            # Create and update the file
+            k_means_results = create_plot_results_table()
+        for k_scores in k_scores_list:
+            k_means_results = update_plot_results_table(k_means_results, k_scores)
+        k_means_results.index = k_means_results.index.astype(int)
 
-    # Removes the first column and formats it like a list
-    x = dataset.drop(dataset.columns[0], axis=1).values
-    vector_dict = generate_vector_dict(dataset)
+        temp_fd, temp_filepath = tempfile.mkstemp(dir=output_folder or '.', suffix='.tmp')
+        try:
+            with os.fdopen(temp_fd, 'w', encoding='utf-8') as file:
+                k_means_results.to_csv(file)
+            # mkstemp creates the file readable by its owner only, the table keeps the usual permissions
+            os.chmod(temp_filepath, get_file_mode(filepath))
+            os.replace(temp_filepath, filepath)
+        except BaseException:
+            os.remove(temp_filepath)
+            raise
 
-    # Number of clusters and max. number of iterations
-    km = KMeans(k=k, max_iterations=500)
-    km.fit(x)
-    clusters = km.get_clusters(vector_dict)
 
-    # Based on the value of K used, change the destination filename
+def get_report_filepath(output_folder, k):
+    """
+    Based on the value of K used, returns the destination filename of the results report
+    """
     filepath_list = (output_folder + MODEL_REPORT_FILENAME).rsplit('.', 1)
-    output_filepath = filepath_list[0] + '-' + str(k) + '.' + filepath_list[1]
+    return filepath_list[0] + '-' + str(k) + '.' + filepath_list[1]
+
+
+def load_feature_matrix(input_filepath, dtype=np.float64, max_memory=None):
+    """
+    Returns the TF-IDF scores matrix, the user story IDs and the vocabulary from either a feature store
+    folder (memory-mapped, without parsing) or a .csv table exported by build_features.
+    The .csv table is parsed in chunks that are converted to sparse rows of the given dtype one at a time, so
+    the dense N x V table is never in memory. The chunks fit in max_memory bytes if given.
+    """
+    if is_feature_store(input_filepath):
+        return load_features(input_filepath, mmap=True)
+
+    import pandas as pd
+    # The first column holds the IDs, the rest of them are the scores of each word
+    vocabulary = pd.read_csv(input_filepath, nrows=0).columns[1:].tolist()
+    chunksize = CSV_CHUNK_SIZE
+    if max_memory is not None:
+        chunksize = get_rows_per_block(max_memory, CSV_ROW_COPIES * np.dtype(np.float64).itemsize *
+                                       max(len(vocabulary), 1))
+    chunks = list(iter_feature_matrix_chunks(input_filepath, chunksize, dtype))
+    if not chunks:
+        return sparse.csr_matrix((0, len(vocabulary)), dtype=dtype), np.array([]), vocabulary
+    x = sparse.vstack([chunk for chunk, _ in chunks], format='csr')
+    return x, np.concatenate([ids for _, ids in chunks]), vocabulary
+
+
+def train_k_means(x, k, ids=None, seed=None, msc_sample_size=None, msc_seed=None, batch_size=None, init='random',
+                  n_init=1, n_jobs=1, algorithm='lloyd', convergence='shift', tolerance=0.0001, dtype=np.float64,
+                  max_memory=None):
+    """
+    Fits the K-Means algorithm with k centroids on the rows of x (identified by ids), and returns the model
+    along with its SSE and MSC scores.
+    The MSC is averaged over msc_sample_size random user stories if given, or over all of them otherwise.
+    Given a batch_size, the centroids are trained with the mini-batch variant of the algorithm.
+    The best of n_init restarts (each one initialized with the init strategy) runs on n_jobs processes.
+    The algorithm ('lloyd', 'elkan' or 'hamerly') sets how the user stories are assigned to the centroids,
+    and the convergence criterion ('shift', 'inertia' or 'labels') with its tolerance when they stop.
+    The scores are fitted as dtype values, with the distance computations split in row blocks that fit in
+    max_memory bytes if given.
+    """
+    # Number of clusters and max. number of iterations
+    if batch_size is not None:
+        km = MiniBatchKMeans(k=k, batch_size=batch_size, max_iterations=100, init=init, n_init=n_init,
+                             random_state=seed, n_jobs=n_jobs, tolerance=tolerance, dtype=dtype,
+                             max_memory=max_memory)
+    else:
+        km = KMeans(k=k, max_iterations=500, init=init, n_init=n_init, random_state=seed, n_jobs=n_jobs,
+                    algorithm=algorithm, convergence=convergence, tolerance=tolerance, dtype=dtype,
+                    max_memory=max_memory)
+    km.fit(x, ids)
+    logging.getLogger(__name__).info('K=' + str(k) + ' stopped after ' + str(km.n_iter_) + ' iterations (' +
+                                     km.convergence_reason_ + ')')
 
     # Calculate SSE and MSC
     sse_score = km.get_sse_score()
+    msc_score = km.get_msc_avg(sample_size=msc_sample_size, random_state=msc_seed)
+    return km, sse_score, msc_score
+
+
+def iter_feature_matrix_chunks(input_filepath, chunksize, dtype=np.float64):
+    """
+    Yields the (TF-IDF scores matrix, user story IDs) chunks of chunksize rows from either a feature store
+    folder or a .csv table exported by build_features, so only one chunk is loaded at a time.
+    The rows of a .csv table are converted to dtype, those of a store keep the dtype they were saved with.
+    """
+    if is_feature_store(input_filepath):
+        yield from iter_feature_chunks(input_filepath, chunksize)
+        return
+
+    import pandas as pd
+    for chunk in pd.read_csv(input_filepath, chunksize=chunksize):
+        # The first column holds the IDs, the rest of them are the scores of each word
+        yield (sparse.csr_matrix(chunk.drop(chunk.columns[0], axis=1).to_numpy(dtype=dtype)),
+               chunk[chunk.columns[0]].values)
+
+
+def train_k_means_chunked(input_filepath, k, chunksize, seed=None, init='random', epochs=3, dtype=np.float64,
+                          max_memory=None):
+    """
+    Fits the mini-batch K-Means algorithm with k centroids one chunk of chunksize user stories at a time,
+    making epochs passes over the chunks. The SSE and MSC scores are then accumulated over two more passes,
+    so the whole scores matrix never has to be in memory.
+    Returns the model and the clusters (user story IDs by cluster) along with the SSE and MSC scores.
+    """
+    km = MiniBatchKMeans(k=k, batch_size=chunksize, init=init, random_state=seed, dtype=dtype,
+                         max_memory=max_memory)
+    for epoch in range(epochs):
+        for x, _ in iter_feature_matrix_chunks(input_filepath, chunksize, dtype):
+            km.partial_fit(x)
+
+    # Assign every chunk to the final centroids, accumulating the SSE and the normalized sums of each cluster
+    clusters = {i: [] for i in range(k)}
+    chunk_labels = []
+    sse_score = 0.0
+    cluster_sums = 0.0
+    counts = np.zeros(k, dtype=np.int64)
+    for x, ids in iter_feature_matrix_chunks(input_filepath, chunksize, dtype):
+        inverse_norms = get_inverse_norms(x)
+        labels = km.predict(x)
+        distances = get_point_distances(x, km.cluster_centers_, labels, inverse_norms, km.block_size_)
+        sse_score += float(np.sum(distances ** 2))
+        cluster_sums = cluster_sums + get_normalized_cluster_sums(x, labels, k, inverse_norms)
+        counts += np.bincount(labels, minlength=k)
+        for i in range(k):
+            clusters[i].extend(ids[labels == i])
+        chunk_labels.append(labels)
+
+    # The silhouette coefficients need the sums of every cluster, so they take a last pass
+    coefficients_sum = 0.0
+    for (x, _), labels in zip(iter_feature_matrix_chunks(input_filepath, chunksize, dtype), chunk_labels):
+        coefficients = get_silhouette_coefficients(x, labels, cluster_sums, counts, get_inverse_norms(x),
+                                                   block_size=km.block_size_)
+        coefficients_sum += float(np.sum(coefficients))
+    msc_score = coefficients_sum / max(int(np.sum(counts)), 1)
+    return km, clusters, sse_score, msc_score
+
+
+def check_model_output(input_filepath):
+    """
+    Raises a usage error if a model can't be saved from the given features, which happens when they don't
+    have the idf of each word (a .csv table, or a store built before they were saved)
+    """
+    if not is_feature_store(input_filepath) or load_idfs(input_filepath) is None:
+        raise click.UsageError('--model-output needs a feature store built by build_features, which saves the '
+                               'idf of each word along with the scores')
+
+
+def save_model(model_folder, input_filepath, centroids):
+    """
+    Saves the centroids along with the vocabulary and idfs of the feature store, and the pre-processing
+    settings, so new raw user stories can be classified with predict_model
+    """
+    # Only the settings are needed from the pre-processing, so NLTK isn't loaded on every training run
+    from src.data.make_dataset import get_preprocessing_config
+    _, _, vocabulary = load_features(input_filepath, mmap=True)
+    model = ClusteringModel(centroids, vocabulary, load_idfs(input_filepath), get_preprocessing_config())
+    model.save(model_folder)
+
+
+def parse_k_range(k_range):
+    """
+    Returns the list of K values given by a range string like '2-10' (both ends included)
+    """
+    first, _, last = k_range.partition('-')
+    if not last:
+        return [int(first)]
+    return list(range(int(first), int(last) + 1))
+
+
+def _init_sweep_worker(store_folder):
+    """
+    Memory-maps the feature store on each worker process, so all of them share the same pages of the matrix
+    """
+    global _sweep_features
+    x, ids, _ = load_features(store_folder, mmap=True)
+    _sweep_features = (x, ids)
+
+
+def _run_sweep_task(task):
+    k, seed, train_options = task
+    x, ids = _sweep_features
+    km, sse_score, msc_score = train_k_means(x, k, ids, seed, **train_options)
+    return k, seed, sse_score, msc_score, km.get_clusters()
+
+
+def run_k_sweep(input_filepath, k_values, seeds=1, jobs=None, first_seed=0, **train_options):
+    """
+    Trains the K-Means algorithm for every K in k_values, with seeds different random seeds each (starting
+    from first_seed), spread across a pool of jobs processes that share the read-only feature matrix
+    through a memory-mapped store. The train_options are passed on to train_k_means.
+    Returns a dictionary with the (seed, SSE, MSC, clusters) results of the lowest SSE run of each K.
+    """
+    logger = logging.getLogger(__name__)
+    tasks = [(k, first_seed + seed, train_options) for k in k_values for seed in range(seeds)]
+
+    with tempfile.TemporaryDirectory() as temp_folder:
+        # A .csv table is parsed once and converted to a temporary store, which the workers memory-map
+        store_folder = input_filepath
+        if not is_feature_store(input_filepath):
+            x, ids, vocabulary = load_feature_matrix(input_filepath, train_options.get('dtype', np.float64),
+                                                     train_options.get('max_memory'))
+            store_folder = os.path.join(temp_folder, 'features')
+            save_features(store_folder, x, ids, vocabulary)
+
+        best_results = {}
+        with get_process_pool(jobs, _init_sweep_worker, (store_folder,)) as executor:
+            for k, seed, sse_score, msc_score, clusters in executor.map(_run_sweep_task, tasks):
+                logger.info('K=' + str(k) + ', seed ' + str(seed) + ': SSE Score: ' + str(sse_score) +
+                            ', MSC Score: ' + str(msc_score))
+                if k not in best_results or sse_score < best_results[k][1]:
+                    best_results[k] = (seed, sse_score, msc_score, clusters)
+    return best_results
+
+
+def run_training(input_filepath, output_folder, k, k_range, seed, seeds, init, n_init, algorithm, convergence,
+                 tolerance, jobs, msc_sample_size, msc_seed, batch_size, chunksize, model_output, dtype, max_memory):
+    """
+    Trains the K-Means algorithm with the options of main, and generates the reports.
+    Returns the trained model (or None for a sweep of K values).
+    """
+    logger = logging.getLogger(__name__)
+    logger.info('Training the K-Means clustering algorithm based on the TF-IDF scores')
+
+    if model_output is not None:
+        if k_range is not None:
+            raise click.UsageError('--model-output can not be combined with --k-range')
+        check_model_output(input_filepath)
+
+    if chunksize is not None:
+        if k_range is not None:
+            raise click.UsageError('--chunksize can not be combined with --k-range')
+        # The streamed chunks are the batches of the mini-batch algorithm, which has no other options
+        ignored = [option for option, value, default in (('--algorithm', algorithm, 'lloyd'), ('--n-init', n_init, 1),
+                                                        ('--convergence', convergence, 'shift'),
+                                                        ('--tolerance', tolerance, 0.0001),
+                                                        ('--msc-sample-size', msc_sample_size, None),
+                                                        ('--batch-size', batch_size, None))
+                   if value != default]
+        if ignored:
+            raise click.UsageError('--chunksize can not be combined with ' + ', '.join(ignored))
+        km, clusters, sse_score, msc_score = train_k_means_chunked(input_filepath, k, chunksize, seed, init,
+                                                                   dtype=dtype, max_memory=max_memory)
+        logger.info('SSE Score: ' + str(sse_score))
+        logger.info('MSC Score: ' + str(msc_score))
+        output_filepath = get_report_filepath(output_folder, k)
+        generate_report(clusters, sse_score, msc_score, output_filepath)
+        logger.info('Created report file on ' + output_filepath)
+        save_plot_results(output_folder, [(k, sse_score, msc_score)])
+        logger.info('Updated report table on ' + output_folder + PLOT_TABLE_FILENAME)
+        if model_output is not None:
+            save_model(model_output, input_filepath, km.cluster_centers_)
+            logger.info('Saved the trained model on ' + model_output)
+        return km
+
+    if k_range is not None:
+        # Sweep every K on a process pool, keeping the lowest SSE run of each one
+        k_values = parse_k_range(k_range)
+        results = run_k_sweep(input_filepath, k_values, seeds, jobs, first_seed=seed or 0,
+                              msc_sample_size=msc_sample_size, msc_seed=msc_seed, batch_size=batch_size,
+                              init=init, n_init=n_init, algorithm=algorithm, convergence=convergence,
+                              tolerance=tolerance, dtype=dtype, max_memory=max_memory)
+        for k_size in k_values:
+            seed, sse_score, msc_score, clusters = results[k_size]
+            output_filepath = get_report_filepath(output_folder, k_size)
+            generate_report(clusters, sse_score, msc_score, output_filepath)
+            logger.info('Created report file on ' + output_filepath + ' (seed ' + str(seed) + ')')
+        save_plot_results(output_folder, [(k_size,) + results[k_size][1:3] for k_size in k_values])
+        logger.info('Updated report table on ' + output_folder + PLOT_TABLE_FILENAME)
+        return
+
+    # Get the models/tf-idf-scores feature store (or .csv file)
+    x, ids, vocabulary = load_feature_matrix(input_filepath, dtype, max_memory)
+    logger.info('Loaded data file ' + input_filepath + ' with ' + str(len(ids)) + ' rows')
+
+    km, sse_score, msc_score = train_k_means(x, k, ids, seed, msc_sample_size=msc_sample_size, msc_seed=msc_seed,
+                                             batch_size=batch_size, init=init, n_init=n_init,
+                                             n_jobs=jobs or os.cpu_count(), algorithm=algorithm,
+                                             convergence=convergence, tolerance=tolerance, dtype=dtype,
+                                             max_memory=max_memory)
+    clusters = km.get_clusters()
     logger.info('SSE Score: ' + str(sse_score))
-    msc_score = km.get_msc_avg()
     logger.info('MSC Score: ' + str(msc_score))
 
     # Generate the results report
+    output_filepath = get_report_filepath(output_folder, k)
     generate_report(clusters, sse_score, msc_score, output_filepath)
     logger.info('Created report file on ' + output_filepath)
 
     # Generate / Update the results table for future plots
-    if os.path.isfile(output_folder + PLOT_TABLE_FILENAME):
-        # Update the existing file
-        dataset = pd.read_csv(output_folder + PLOT_TABLE_FILENAME)
-        dataset.set_index('K Size', inplace=True)
-        k_means_results = update_plot_results_table(dataset, (k, sse_score, msc_score))
-    else:
-        # Create and update the file
-        dataset = create_plot_results_table()
-        k_means_results = update_plot_results_table(dataset, (k, sse_score, msc_score))
-    k_means_results.to_csv(output_folder + PLOT_TABLE_FILENAME, encoding='utf-8')
+    save_plot_results(output_folder, [(k, sse_score, msc_score)])
     logger.info('Updated report table on ' + output_folder + PLOT_TABLE_FILENAME)
 
+    if model_output is not None:
+        save_model(model_output, input_filepath, km.cluster_centers_)
+        logger.info('Saved the trained model on ' + model_output)
+    return km
+
+
+@click.command()
+@click.argument('input_filepath', type=click.Path(exists=True))
+@click.argument('output_folder', type=click.Path())
+@click.option('--k', default=3, help='Number of centroids.')
+@click.option('--k-range', default=None,
+              help='Range of centroid numbers to sweep, e.g. 2-10. Overrides --k.')
+@click.option('--seed', default=None, type=int, help='Random seed of the centroid initialization.')
+@click.option('--seeds', default=1, help='Number of random seeds tried for each K of the sweep.')
+@click.option('--init', default='random', type=click.Choice(INIT_STRATEGIES),
+              help='Strategy used to pick the initial centroids.')
+@click.option('--n-init', default=1, help='Number of restarts of the algorithm, keeping the lowest SSE one.')
+@click.option('--algorithm', default='lloyd', type=click.Choice(ALGORITHMS),
+              help='Assignment algorithm, elkan and hamerly skip distance computations with triangle inequality bounds.')
+@click.option('--convergence', default='shift', type=click.Choice(CONVERGENCE_CRITERIA),
+              help='Convergence criterion: the largest centroid shift, the relative change of the inertia or the '
+                   'fraction of user stories that changed cluster must fall below the tolerance.')
+@click.option('--tolerance', default=0.0001, help='Threshold of the convergence criterion.')
+@click.option('--jobs', default=None, type=int,
+              help='Number of worker processes for the sweep (or the restarts). Defaults to the number of CPUs.')
+@click.option('--msc-sample-size', default=None, type=int,
+              help='Approximate the MSC score with this many randomly sampled user stories.')
+@click.option('--msc-seed', default=None, type=int, help='Random seed used to sample the MSC user stories.')
+@click.option('--batch-size', default=None, type=int,
+              help='Train with the mini-batch K-Means algorithm, using batches of this many user stories.')
+@click.option('--chunksize', default=None, type=int,
+              help='Stream the scores in chunks of this many user stories, training the mini-batch algorithm '
+                   'on one chunk at a time.')
+@click.option('--dtype', default='float64', type=click.Choice(DTYPES),
+              help='Floating point type of the scores and the centroids. float32 halves their memory.')
+@click.option('--max-memory', default=None, type=MemorySize(),
+              help='Memory budget (e.g. 512MB, 2GB) that sets the number of user stories in each block of the '
+                   'distance and silhouette computations, and in each chunk parsed from a .csv table.')
+@click.option('--model-output', default=None, type=click.Path(),
+              help='Folder where the trained model is saved, to classify new user stories with predict_model.')
+@click.option('--profile', 'profile_filepath', default=None, type=click.Path(),
+              help='Profile the run with cProfile and dump the results (with the per-iteration history of the '
+                   'model) as JSON on this file.')
+@click.option('--profile-memory', is_flag=True,
+              help='Also trace the memory allocations of the profiled run with tracemalloc.')
+@click.option('--verbose', is_flag=True, help='Log the details of every iteration of the algorithm.')
+def main(input_filepath, output_folder, k, k_range, seed, seeds, init, n_init, algorithm, convergence, tolerance,
+         jobs, msc_sample_size, msc_seed, batch_size, chunksize, dtype, max_memory, model_output, profile_filepath,
+         profile_memory, verbose):
+    """
+    Receives the location of the tf-idf scores (a feature store folder or a .csv table) as a
+    command-line Path argument.
+    """
+    if verbose:
+        logging.getLogger('src.models.k_means').setLevel(logging.DEBUG)
+    options = (input_filepath, output_folder, k, k_range, seed, seeds, init, n_init, algorithm, convergence,
+               tolerance, jobs, msc_sample_size, msc_seed, batch_size, chunksize, model_output, dtype, max_memory)
+    if profile_filepath is None:
+        run_training(*options)
+        return
+
+    # Only the main process is profiled, the workers of a sweep or of the restarts run on their own
+    with profile_run(profile_filepath, memory=profile_memory) as profile_report:
+        km = run_training(*options)
+        if km is not None:
+            profile_report['history'] = km.history_
+    logging.getLogger(__name__).info('Saved the profile of the run on ' + profile_filepath)
+
 
 if __name__ == '__main__':
     log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
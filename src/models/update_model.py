@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+import click
+import json
+import logging
+import os
+import os.path
+import numpy as np
+from src.data.make_dataset import get_preprocessing_config
+from src.features.build_features import compute_idfs, count_document_frequencies, read_dataset, transform
+from src.features.feature_store import write_folder
+from src.models.k_means import INIT_STRATEGIES, KMeans, assign_clusters, get_membership_matrix
+from src.models.model_io import ClusteringModel
+
+# String constants
+STATE_FILENAME = 'state.json'
+VOCABULARY_FILENAME = 'vocabulary.json'
+DOCUMENT_FREQUENCIES_FILENAME = 'document-frequencies.npy'
+CLUSTER_SUMS_FILENAME = 'cluster-sums.npy'
+CLUSTER_COUNTS_FILENAME = 'cluster-counts.npy'
+ASSIGNMENTS_FILENAME = 'assignments.csv'
+MODEL_FOLDERNAME = 'model'
+
+
+def is_clustering_state(folder):
+    """
+    Returns True if the given folder holds a clustering state saved by save_state
+    """
+    return os.path.isfile(os.path.join(folder, STATE_FILENAME))
+
+
+def save_state(folder, state):
+    """
+    Saves the clustering state on the given folder: the vocabulary (in column order), the document frequency
+    of each word, and the sum of the term frequencies and the number of user stories of each cluster.
+    """
+    with write_folder(folder, STATE_FILENAME) as state_file:
+        with open(os.path.join(folder, VOCABULARY_FILENAME), 'w', encoding='utf-8') as file:
+            json.dump(state['vocabulary'], file)
+        np.save(os.path.join(folder, DOCUMENT_FREQUENCIES_FILENAME), state['document_frequencies'])
+        np.save(os.path.join(folder, CLUSTER_SUMS_FILENAME), state['cluster_sums'])
+        np.save(os.path.join(folder, CLUSTER_COUNTS_FILENAME), state['counts'])
+        state_file.update(k=state['k'], n_documents=state['n_documents'])
+
+
+def load_state(folder):
+    """
+    Loads the clustering state saved on the given folder
+    """
+    with open(os.path.join(folder, STATE_FILENAME), encoding='utf-8') as file:
+        state = json.load(file)
+    with open(os.path.join(folder, VOCABULARY_FILENAME), encoding='utf-8') as file:
+        state['vocabulary'] = json.load(file)
+    state['document_frequencies'] = list(np.load(os.path.join(folder, DOCUMENT_FREQUENCIES_FILENAME)))
+    state['cluster_sums'] = np.load(os.path.join(folder, CLUSTER_SUMS_FILENAME))
+    state['counts'] = np.load(os.path.join(folder, CLUSTER_COUNTS_FILENAME))
+    return state
+
+
+def append_assignments(folder, ids, labels):
+    """
+    Appends the cluster of each new user story to the assignments table of the state folder
+    """
+    import pandas as pd
+    filepath = os.path.join(folder, ASSIGNMENTS_FILENAME)
+    assignments = pd.DataFrame({'id': ids, 'cluster': labels})
+    assignments.to_csv(filepath, index=False, mode='a', header=not os.path.isfile(filepath))
+
+
+def get_centroids(cluster_sums, counts, idfs):
+    """
+    Returns the TF-IDF centroids of the clusters. The idf of a word is the same for every user story, so the
+    average of the TF-IDF scores of a cluster is the average of its term frequencies times the idfs. That way
+    the centroids always follow the current idfs, without going over the older user stories again.
+    """
+    centroids = np.zeros_like(cluster_sums)
+    non_empty = counts > 0
+    centroids[non_empty] = cluster_sums[non_empty] / counts[non_empty, np.newaxis]
+    return centroids * idfs[np.newaxis, :]
+
+
+def get_model(state):
+    """
+    Returns the model of the current clusters of the clustering state, which can be saved and loaded like
+    the ones of train_model to classify new raw user stories with predict_model or serve_model
+    """
+    idfs = compute_idfs(state['document_frequencies'], state['n_documents'])
+    centroids = get_centroids(state['cluster_sums'], state['counts'], idfs)
+    return ClusteringModel(centroids, state['vocabulary'], idfs, get_preprocessing_config())
+
+
+def refine_clusters(cluster_sums, counts, tf_matrix, idfs, iterations):
+    """
+    Assigns the new user stories (given by their term frequencies) to the clusters, starting from the current
+    centroids, and then alternates updating the centroids with them and re-assigning them for a few iterations.
+    The older user stories keep their clusters, so each iteration only goes over the new ones.
+    Returns the labels of the new user stories and the updated cluster sums and counts.
+    """
+    k = len(counts)
+    x = tf_matrix.multiply(idfs[np.newaxis, :]).tocsr()
+    new_sums = np.zeros_like(cluster_sums)
+    new_counts = np.zeros_like(counts)
+    labels = None
+    for iteration in range(iterations):
+        centroids = get_centroids(cluster_sums + new_sums, counts + new_counts, idfs)
+        new_labels, _ = assign_clusters(x, centroids)
+
+        # Stop once the new user stories stay in the same clusters
+        if labels is not None and np.array_equal(new_labels, labels):
+            break
+        labels = new_labels
+        new_sums = np.asarray((get_membership_matrix(labels, k) @ tf_matrix).todense())
+        new_counts = np.bincount(labels, minlength=k)
+    return labels, cluster_sums + new_sums, counts + new_counts
+
+
+def create_state(dataset, k, seed=None, init='random'):
+    """
+    Fits the K-Means algorithm on the whole dataset and returns the clustering state that later updates start
+    from, along with the labels of the user stories
+    """
+    vocabulary_index = {}
+    document_frequencies = []
+    count_document_frequencies(dataset, vocabulary_index, document_frequencies)
+    idfs = compute_idfs(document_frequencies, len(dataset))
+
+    tf_matrix = transform(dataset, vocabulary_index, np.ones(len(document_frequencies)))
+    km = KMeans(k=k, init=init, random_state=seed)
+    km.fit(tf_matrix.multiply(idfs[np.newaxis, :]).tocsr())
+
+    state = {
+        'k': k,
+        'n_documents': len(dataset),
+        'vocabulary': sorted(vocabulary_index, key=vocabulary_index.get),
+        'document_frequencies': document_frequencies,
+        'cluster_sums': np.asarray((get_membership_matrix(km.labels_, k) @ tf_matrix).todense()),
+        'counts': np.bincount(km.labels_, minlength=k),
+    }
+    return state, km.labels_
+
+
+def update_state(state, dataset, iterations=3):
+    """
+    Adds the new user stories of the dataset to the clustering state: the words they bring are appended to
+    the vocabulary, the document frequencies (and so the idfs) are updated with them, and they are assigned
+    to the clusters with refine_clusters. It only takes time proportional to the number of new user stories.
+    Returns the labels of the new user stories.
+    """
+    vocabulary_index = {word: column for column, word in enumerate(state['vocabulary'])}
+    count_document_frequencies(dataset, vocabulary_index, state['document_frequencies'])
+    state['n_documents'] += len(dataset)
+    idfs = compute_idfs(state['document_frequencies'], state['n_documents'])
+
+    # New words get new columns at the end, with no term frequencies on the existing clusters
+    n_new_words = len(vocabulary_index) - len(state['vocabulary'])
+    state['vocabulary'] = sorted(vocabulary_index, key=vocabulary_index.get)
+    cluster_sums = np.pad(state['cluster_sums'], ((0, 0), (0, n_new_words)))
+
+    tf_matrix = transform(dataset, vocabulary_index, np.ones(len(vocabulary_index)))
+    labels, state['cluster_sums'], state['counts'] = refine_clusters(cluster_sums, state['counts'], tf_matrix,
+                                                                     idfs, iterations)
+    return labels
+
+
+@click.command()
+@click.argument('state_folder', type=click.Path())
+@click.argument('input_filepath', type=click.Path(exists=True))
+@click.option('--k', default=3, help='Number of centroids, used when the state folder is created.')
+@click.option('--seed', default=None, type=int, help='Random seed of the centroid initialization.')
+@click.option('--init', default='random', type=click.Choice(INIT_STRATEGIES),
+              help='Strategy used to pick the initial centroids, used when the state folder is created.')
+@click.option('--iterations', default=3, type=click.IntRange(min=1),
+              help='Number of refinement iterations over the new user stories.')
+def main(state_folder, input_filepath, k, seed, init, iterations):
+    """
+    Adds the pre-processed user stories of input_filepath to the clusters saved on state_folder. If the
+    folder has no clustering state yet, it is created by fitting K-Means on them. The model of the updated
+    clusters is saved on the model subfolder of state_folder, for predict_model and serve_model.
+    """
+    logger = logging.getLogger(__name__)
+
+    dataset = read_dataset(input_filepath)
+    logger.info('Loaded data file ' + input_filepath + ' with ' + str(len(dataset)) + ' rows')
+
+    if is_clustering_state(state_folder):
+        logger.info('Updating the clusters saved on ' + state_folder + ' with the new user stories')
+        state = load_state(state_folder)
+        labels = update_state(state, dataset, iterations)
+    else:
+        logger.info('Creating a new clustering state on ' + state_folder)
+        state, labels = create_state(dataset, k, seed, init)
+
+    save_state(state_folder, state)
+    append_assignments(state_folder, dataset['id'].values, labels)
+    model_folder = os.path.join(state_folder, MODEL_FOLDERNAME)
+    get_model(state).save(model_folder)
+    logger.info('Saved the clustering state of ' + str(state['n_documents']) + ' user stories, with ' +
+                str(len(state['vocabulary'])) + ' words')
+    logger.info('User stories by cluster: ' + ', '.join(str(int(count)) for count in state['counts']))
+    logger.info('Saved the model of the updated clusters on ' + model_folder)
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    main()
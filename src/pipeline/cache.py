@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+from contextlib import contextmanager
+
+# String constants
+MANIFEST_FILENAME = 'manifest.json'
+FILE_HASHES_FILENAME = 'file-hashes.json'
+OUTPUT_NAME = 'output'
+
+# Number of bytes read at a time while hashing a file
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+def hash_file(filepath):
+    """
+    Returns the SHA-256 hex digest of the content of a file
+    """
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as file:
+        for block in iter(lambda: file.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def get_fingerprint(*parts):
+    """
+    Returns a SHA-256 hex digest of the given JSON-serializable parts (parameters, hashes of the inputs,
+    fingerprints of the upstream stages...), which changes whenever any of them does
+    """
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def get_size(path):
+    """
+    Returns the total size in bytes of a file, or of all the files inside a folder
+    """
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(folder, filename))
+               for folder, _, filenames in os.walk(path) for filename in filenames)
+
+
+class StageCache:
+    """
+    Folder with the outputs of the pipeline stages, one entry per fingerprint of their inputs and parameters.
+    The entries are evicted in least recently used order once their total size goes over max_size bytes.
+    Each entry is written on a temporary folder and renamed when complete, so a stage that fails midway never
+    leaves a partial output behind.
+    """
+
+    def __init__(self, folder, max_size=None):
+        self.folder = folder
+        self.max_size = max_size
+        os.makedirs(folder, exist_ok=True)
+        self._file_hashes = self._load_file_hashes()
+
+    def _load_file_hashes(self):
+        filepath = os.path.join(self.folder, FILE_HASHES_FILENAME)
+        if not os.path.isfile(filepath):
+            return {}
+        with open(filepath, encoding='utf-8') as file:
+            return json.load(file)
+
+    def _write_json(self, filepath, content):
+        temp_fd, temp_filepath = tempfile.mkstemp(dir=os.path.dirname(filepath), suffix='.tmp')
+        with os.fdopen(temp_fd, 'w', encoding='utf-8') as file:
+            json.dump(content, file, indent=2)
+        os.replace(temp_filepath, filepath)
+
+    def hash_path(self, path):
+        """
+        Returns the content hash of a file (or of every file inside a folder). The hash of each file is
+        remembered along with its size and modification time, so unchanged files aren't read again.
+        """
+        if os.path.isdir(path):
+            return get_fingerprint(*((os.path.relpath(os.path.join(folder, filename), path),
+                                      self.hash_path(os.path.join(folder, filename)))
+                                     for folder, _, filenames in sorted(os.walk(path))
+                                     for filename in sorted(filenames)))
+
+        key = os.path.abspath(path)
+        stat = os.stat(path)
+        known = self._file_hashes.get(key)
+        if known is not None and known['size'] == stat.st_size and known['mtime_ns'] == stat.st_mtime_ns:
+            return known['sha256']
+        digest = hash_file(path)
+        self._file_hashes[key] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': digest}
+        self._write_json(os.path.join(self.folder, FILE_HASHES_FILENAME), self._file_hashes)
+        return digest
+
+    def get_entry_folder(self, stage, fingerprint):
+        return os.path.join(self.folder, stage + '-' + fingerprint[:16])
+
+    def get(self, stage, fingerprint):
+        """
+        Returns the path of the cached output of a stage run with the given fingerprint, marking it as
+        recently used, or None if it isn't cached
+        """
+        entry_folder = self.get_entry_folder(stage, fingerprint)
+        manifest_filepath = os.path.join(entry_folder, MANIFEST_FILENAME)
+        if not os.path.isfile(manifest_filepath):
+            return None
+        with open(manifest_filepath, encoding='utf-8') as file:
+            manifest = json.load(file)
+        if manifest['fingerprint'] != fingerprint:
+            return None
+        manifest['last_used'] = time.time()
+        self._write_json(manifest_filepath, manifest)
+        return os.path.join(entry_folder, OUTPUT_NAME)
+
+    @contextmanager
+    def create(self, stage, fingerprint):
+        """
+        Yields the path where a stage writes its output, which is added to the cache once the context exits
+        without errors (along with a manifest with its fingerprint, size and last use)
+        """
+        entry_folder = self.get_entry_folder(stage, fingerprint)
+        temp_folder = tempfile.mkdtemp(dir=self.folder, prefix='.' + stage + '-')
+        try:
+            yield os.path.join(temp_folder, OUTPUT_NAME)
+            now = time.time()
+            manifest = {'stage': stage, 'fingerprint': fingerprint, 'created': now, 'last_used': now,
+                        'size': get_size(temp_folder)}
+            with open(os.path.join(temp_folder, MANIFEST_FILENAME), 'w', encoding='utf-8') as file:
+                json.dump(manifest, file, indent=2)
+            if os.path.isdir(entry_folder):
+                shutil.rmtree(entry_folder)
+            os.replace(temp_folder, entry_folder)
+        finally:
+            if os.path.isdir(temp_folder):
+                shutil.rmtree(temp_folder)
+
+    def get_entries(self):
+        """
+        Returns the manifests of the entries of the cache, with the folder of each one
+        """
+        entries = []
+        for name in os.listdir(self.folder):
+            manifest_filepath = os.path.join(self.folder, name, MANIFEST_FILENAME)
+            if name.startswith('.') or not os.path.isfile(manifest_filepath):
+                continue
+            with open(manifest_filepath, encoding='utf-8') as file:
+                manifest = json.load(file)
+            manifest['folder'] = os.path.join(self.folder, name)
+            entries.append(manifest)
+        return entries
+
+    def evict(self, keep=()):
+        """
+        Removes the least recently used entries until the cache fits in max_size bytes, except for those on
+        the keep folders (the outputs of the current run). Returns the number of entries removed.
+        """
+        if self.max_size is None:
+            return 0
+        logger = logging.getLogger(__name__)
+        keep = {os.path.abspath(folder) for folder in keep}
+        entries = sorted(self.get_entries(), key=lambda entry: entry['last_used'])
+        total_size = sum(entry['size'] for entry in entries)
+        removed = 0
+        for entry in entries:
+            if total_size <= self.max_size:
+                break
+            if os.path.abspath(entry['folder']) in keep:
+                continue
+            shutil.rmtree(entry['folder'])
+            total_size -= entry['size']
+            removed += 1
+            logger.info('Evicted ' + entry['stage'] + ' output ' + os.path.basename(entry['folder']) +
+                        ' from the cache')
+        return removed
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+import ast
+import click
+import logging
+import os
+import shutil
+import tempfile
+from importlib.metadata import PackageNotFoundError, version
+from importlib.util import find_spec
+from src.features.reduce_features import REDUCTION_METHODS
+from src.memory import DTYPES, MemorySize
+from src.models.k_means import ALGORITHMS, CONVERGENCE_CRITERIA, INIT_STRATEGIES
+from src.pipeline.cache import StageCache, get_fingerprint
+
+# Module that implements each stage. Its source, and that of every module of the package it imports, is part of
+# the fingerprint of the stage, so a code change re-runs it
+STAGE_MODULES = {
+    'preprocess': 'src.data.make_dataset',
+    'features': 'src.features.build_features',
+    'reduce': 'src.features.reduce_features',
+    'train': 'src.models.train_model',
+}
+
+# Package whose modules are followed through the imports
+PACKAGE_NAME = 'src'
+
+
+def is_package_module(name):
+    """
+    Returns whether name is a module of the package (and not, e.g., a function imported from one)
+    """
+    if name.split('.')[0] != PACKAGE_NAME:
+        return False
+    if '.' in name:
+        # Only a package can hold submodules, and looking one up in a module would import that module
+        parent = find_spec(name.rsplit('.', 1)[0])
+        if parent is None or parent.submodule_search_locations is None:
+            return False
+    return find_spec(name) is not None
+
+
+def get_imported_modules(module):
+    """
+    Returns the modules of the package imported anywhere in the source of a module (including the imports
+    inside functions), read without importing it
+    """
+    with open(find_spec(module).origin, encoding='utf-8') as file:
+        tree = ast.parse(file.read())
+    imported = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            imported.update(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.module is not None and node.level == 0:
+            # 'from package import module' imports a module too
+            imported.add(node.module)
+            imported.update(node.module + '.' + alias.name for alias in node.names)
+    return {name for name in imported if is_package_module(name)}
+
+
+def get_stage_modules(stage):
+    """
+    Returns the sorted names of the module that implements a stage and of all the modules it depends on
+    """
+    modules = set()
+    pending = [STAGE_MODULES[stage]]
+    while pending:
+        module = pending.pop()
+        if module not in modules:
+            modules.add(module)
+            pending.extend(get_imported_modules(module) - modules)
+    return sorted(module for module in modules if find_spec(module).origin is not None)
+
+
+def get_source_hashes(cache, stage):
+    """
+    Returns the content hashes of the source files of the modules that a stage depends on, found without
+    importing them
+    """
+    return [cache.hash_path(find_spec(module).origin) for module in get_stage_modules(stage)]
+
+
+def get_nltk_settings():
+    """
+    Returns the NLTK version and the data folders it is configured to look in, which set the tokenizer,
+    tagger and lemmatizer used by the pre-processing
+    """
+    try:
+        nltk_version = version('nltk')
+    except PackageNotFoundError:
+        nltk_version = None
+    return {'version': nltk_version, 'data': os.environ.get('NLTK_DATA')}
+
+
+def run_stage(cache, stage, fingerprint, run, force=False):
+    """
+    Returns the output of a stage from the cache if a run with the same fingerprint is there, or calls run
+    with the path where it must write a new one otherwise
+    """
+    logger = logging.getLogger(__name__)
+    output = None if force else cache.get(stage, fingerprint)
+    if output is not None:
+        logger.info('Stage ' + stage + ' is unchanged, reusing ' + output)
+        return output
+
+    logger.info('Running stage ' + stage + ' (' + fingerprint[:16] + ')')
+    with cache.create(stage, fingerprint) as output:
+        run(output)
+    return cache.get(stage, fingerprint)
+
+
+def run_preprocess(input_filepath, output_filepath, jobs):
+    from src.data import make_dataset
+    make_dataset.main.main([input_filepath, output_filepath] + (['--jobs', str(jobs)] if jobs else []),
+                           standalone_mode=False)
+
+
+def run_features(input_filepath, output_folder, dtype):
+    from src.features import build_features
+    build_features.main.main([input_filepath, output_folder, '--dtype', dtype], standalone_mode=False)
+
+
+def run_reduce(input_folder, output_folder, options):
+    from src.features import reduce_features
+    arguments = [input_folder, output_folder]
+    for name, value in options.items():
+        if value is not None:
+            arguments += ['--' + name.replace('_', '-'), str(value)]
+    reduce_features.main.main(arguments, standalone_mode=False)
+
+
+def run_train(input_folder, output_folder, options, jobs):
+    from src.models import train_model
+    os.makedirs(output_folder)
+    arguments = [input_folder, output_folder + os.sep] + (['--jobs', str(jobs)] if jobs else [])
+    for name, value in options.items():
+        if value is not None:
+            arguments += ['--' + name.replace('_', '-'), str(value)]
+    train_model.main.main(arguments, standalone_mode=False)
+
+
+def publish_reports(reports_folder, output_folder, k_values):
+    """
+    Copies the cluster reports of the trained K values to the output folder, and adds their scores to its
+    results table
+    """
+    import pandas as pd
+    from src.models.train_model import get_report_filepath, save_plot_results, PLOT_TABLE_FILENAME
+    reports_folder += os.sep
+    output_folder += os.sep
+    os.makedirs(output_folder, exist_ok=True)
+    for k in k_values:
+        shutil.copyfile(get_report_filepath(reports_folder, k), get_report_filepath(output_folder, k))
+    scores = pd.read_csv(reports_folder + PLOT_TABLE_FILENAME, index_col='K Size')
+    save_plot_results(output_folder, [(k, scores.loc[k, 'SSE Score'], scores.loc[k, 'MSC Score'])
+                                      for k in k_values])
+
+
+@click.command()
+@click.argument('input_filepath', type=click.Path(exists=True))
+@click.argument('output_folder', type=click.Path())
+@click.option('--k', default=3, help='Number of centroids.')
+@click.option('--k-range', default=None, help='Range of centroid numbers to sweep, e.g. 2-10. Overrides --k.')
+@click.option('--seed', default=None, type=int, help='Random seed of the centroid initialization.')
+@click.option('--seeds', default=1, help='Number of random seeds tried for each K of the sweep.')
+@click.option('--init', default='random', type=click.Choice(INIT_STRATEGIES),
+              help='Strategy used to pick the initial centroids.')
+@click.option('--n-init', default=1, help='Number of restarts of the algorithm, keeping the lowest SSE one.')
+@click.option('--algorithm', default='lloyd', type=click.Choice(ALGORITHMS), help='Assignment algorithm.')
+@click.option('--convergence', default='shift', type=click.Choice(CONVERGENCE_CRITERIA),
+              help='Convergence criterion of the algorithm.')
+@click.option('--tolerance', default=0.0001, help='Threshold of the convergence criterion.')
+@click.option('--batch-size', default=None, type=int,
+              help='Train with the mini-batch K-Means algorithm, using batches of this many user stories.')
+@click.option('--msc-sample-size', default=None, type=int,
+              help='Approximate the MSC score with this many randomly sampled user stories.')
+@click.option('--msc-seed', default=None, type=int, help='Random seed used to sample the MSC user stories.')
+@click.option('--dtype', default='float64', type=click.Choice(DTYPES),
+              help='Floating point type of the scores and the centroids.')
+@click.option('--reduce', 'reduce_method', default=None, type=click.Choice(REDUCTION_METHODS),
+              help='Add the reduce_features stage with this method between the features and the training.')
+@click.option('--min-df', default=None, type=int, help='Minimum document frequency of the reduce stage.')
+@click.option('--max-df', default=None, type=float, help='Maximum document frequency of the reduce stage.')
+@click.option('--max-features', default=None, type=int, help='Maximum number of words of the reduce stage.')
+@click.option('--n-components', default=None, type=int, help='Number of dimensions of the reduce stage.')
+@click.option('--cache-dir', default='.pipeline-cache', type=click.Path(),
+              help='Folder where the outputs of every stage are cached.')
+@click.option('--max-cache-size', default=None, type=MemorySize(),
+              help='Size (e.g. 5GB) over which the least recently used outputs are evicted from the cache.')
+@click.option('--jobs', default=None, type=int, help='Number of worker processes of each stage.')
+@click.option('--force', is_flag=True, help='Re-run every stage, replacing their cached outputs.')
+def main(input_filepath, output_folder, k, k_range, seed, seeds, init, n_init, algorithm, convergence, tolerance,
+         batch_size, msc_sample_size, msc_seed, dtype, reduce_method, min_df, max_df, max_features, n_components,
+         cache_dir, max_cache_size, jobs, force):
+    """
+    Runs the whole pipeline (make_dataset, build_features, optionally reduce_features, and train_model) on the
+    raw dataset at input_filepath, writing the reports on output_folder. Each stage is fingerprinted by the
+    content of its inputs, its parameters and its code, and skipped when its output is already cached.
+    """
+    logger = logging.getLogger(__name__)
+    cache = StageCache(cache_dir, max_cache_size)
+    # The stopword lists are the .json files next to the make_dataset script
+    data_folder = os.path.dirname(find_spec('src.data.make_dataset').origin)
+    stopword_hashes = [cache.hash_path(os.path.join(data_folder, filename))
+                       for filename in sorted(os.listdir(data_folder)) if filename.endswith('.json')]
+
+    fingerprint = get_fingerprint('preprocess', cache.hash_path(input_filepath), stopword_hashes,
+                                  get_nltk_settings(), get_source_hashes(cache, 'preprocess'))
+    processed = run_stage(cache, 'preprocess', fingerprint, lambda output: run_preprocess(input_filepath, output,
+                                                                                             jobs), force)
+    outputs = [processed]
+
+    fingerprint = get_fingerprint('features', fingerprint, dtype, get_source_hashes(cache, 'features'))
+    features = run_stage(cache, 'features', fingerprint, lambda output: run_features(processed, output, dtype),
+                         force)
+    outputs.append(features)
+
+    if reduce_method is not None:
+        reduce_options = {'method': reduce_method, 'min_df': min_df, 'max_df': max_df, 'max_features': max_features,
+                          'n_components': n_components, 'seed': seed, 'dtype': dtype}
+        fingerprint = get_fingerprint('reduce', fingerprint, reduce_options, get_source_hashes(cache, 'reduce'))
+        source_features = features
+        features = run_stage(cache, 'reduce', fingerprint,
+                             lambda output: run_reduce(source_features, output, reduce_options), force)
+        outputs.append(features)
+
+    train_options = {'k': None if k_range else k, 'k_range': k_range, 'seed': seed,
+                     'seeds': seeds if k_range else None, 'init': init, 'n_init': n_init, 'algorithm': algorithm,
+                     'convergence': convergence, 'tolerance': tolerance, 'batch_size': batch_size,
+                     'msc_sample_size': msc_sample_size, 'msc_seed': msc_seed, 'dtype': dtype}
+    from src.models.train_model import parse_k_range
+    k_values = parse_k_range(k_range) if k_range else [k]
+    if seed is None:
+        # Without a seed the training isn't deterministic, so its output is neither cached nor replayed
+        logger.info('Running stage train without caching it, since no --seed was given')
+        with tempfile.TemporaryDirectory(dir=cache_dir, prefix='.train-') as temp_folder:
+            reports = os.path.join(temp_folder, 'output')
+            run_train(features, reports, train_options, jobs)
+            publish_reports(reports, output_folder, k_values)
+    else:
+        fingerprint = get_fingerprint('train', fingerprint, train_options, get_source_hashes(cache, 'train'))
+        reports = run_stage(cache, 'train', fingerprint,
+                            lambda output: run_train(features, output, train_options, jobs), force)
+        outputs.append(reports)
+        publish_reports(reports, output_folder, k_values)
+    logger.info('Saved the reports on ' + output_folder)
+
+    cache.evict(keep=[os.path.dirname(output) for output in outputs])
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    main()
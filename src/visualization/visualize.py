@@ -1,8 +1,6 @@
 # -*- coding: utf-8 -*-
 import click
 import logging
-import pandas as pd
-import matplotlib.pyplot as plt
 
 # String constants
 SSE_PLOT_FILENAME = 'sse-scores-plot.png'
@@ -17,6 +15,13 @@ def main(input_filepath, output_folder):
     Receives the location of the SSE/MSC scores as a
     command-line Path argument.
     """
+    # pandas and matplotlib are only loaded here, and the plots are drawn on the non-interactive Agg backend,
+    # which doesn't need a display
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    import pandas as pd
+
     logger = logging.getLogger(__name__)
     logger.info('Generating SSE/MSC plots')
 
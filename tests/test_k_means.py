@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+from scipy import sparse
+from src.models.k_means import KMeans
+
+
+def get_data_with_zero_rows(sparse_format):
+    rng = np.random.default_rng(0)
+    data = np.abs(rng.standard_normal((400, 12))) * (rng.random((400, 12)) < 0.4)
+    data[:100] = 0
+    return sparse.csr_matrix(data) if sparse_format else data
+
+
+def fit_all_algorithms(data, **options):
+    models = {}
+    for algorithm in ('lloyd', 'hamerly', 'elkan'):
+        models[algorithm] = KMeans(algorithm=algorithm, **options)
+        models[algorithm].fit(data)
+    return models
+
+
+def assert_same_results(models):
+    lloyd = models['lloyd']
+    for algorithm in ('hamerly', 'elkan'):
+        np.testing.assert_array_equal(models[algorithm].labels_, lloyd.labels_)
+        assert models[algorithm].history_[-1]['inertia'] == pytest.approx(lloyd.history_[-1]['inertia'])
+
+
+@pytest.mark.parametrize('sparse_format', [False, True])
+@pytest.mark.parametrize('seed', range(5))
+def test_bounded_algorithms_match_lloyd_with_zero_rows(sparse_format, seed):
+    assert_same_results(fit_all_algorithms(get_data_with_zero_rows(sparse_format), k=6, random_state=seed))
+
+
+@pytest.mark.parametrize('sparse_format', [False, True])
+def test_bounded_algorithms_match_lloyd_with_zero_initial_centroid(sparse_format):
+    data = get_data_with_zero_rows(sparse_format)
+    init = np.asarray(sparse.csr_matrix(data)[[30, 60, 90, 120]].todense())
+    init[1] = 0
+    assert_same_results(fit_all_algorithms(data, k=4, init=init))
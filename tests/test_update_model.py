@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+import os
+import numpy as np
+import pandas as pd
+from click.testing import CliRunner
+from src.features.build_features import compute_idfs
+from src.models.model_io import ClusteringModel
+from src.models.update_model import ASSIGNMENTS_FILENAME, MODEL_FOLDERNAME, get_centroids, load_state, main
+
+TOPICS = [['light', 'lamp', 'bright', 'dim', 'switch'], ['door', 'lock', 'key', 'open', 'guest'],
+          ['water', 'garden', 'plant', 'sprinkler', 'soil']]
+
+
+def get_dataset(n_rows, seed, first_id=0):
+    rng = np.random.default_rng(seed)
+    rows = []
+    for row in range(n_rows):
+        words = TOPICS[row % len(TOPICS)] + ['extra' + str(seed)]
+        rows.append({'id': first_id + row, 'role': 'user',
+                     'feature': ' '.join(rng.choice(words, size=4)),
+                     'benefit': ' '.join(rng.choice(words, size=3))})
+    return pd.DataFrame(rows)
+
+
+def test_updated_model_classifies_like_the_state(tmp_path):
+    state_folder = str(tmp_path / 'state')
+    runner = CliRunner()
+    for seed, first_id in ((0, 0), (1, 60)):
+        input_filepath = str(tmp_path / ('stories-' + str(seed) + '.csv'))
+        dataset = get_dataset(60, seed, first_id)
+        dataset.to_csv(input_filepath, index=False)
+        result = runner.invoke(main, [state_folder, input_filepath, '--k', '3', '--seed', '0',
+                                      '--iterations', '20'])
+        assert result.exit_code == 0, result.output
+
+    state = load_state(state_folder)
+    model = ClusteringModel.load(os.path.join(state_folder, MODEL_FOLDERNAME))
+    assert model.vocabulary == state['vocabulary']
+    idfs = compute_idfs(state['document_frequencies'], state['n_documents'])
+    np.testing.assert_allclose(model.idfs, idfs)
+    np.testing.assert_allclose(model.centroids, get_centroids(state['cluster_sums'], state['counts'], idfs))
+
+    # The refinement converged, so the saved model assigns the new user stories to the clusters they were added to
+    assignments = pd.read_csv(os.path.join(state_folder, ASSIGNMENTS_FILENAME))
+    np.testing.assert_array_equal(model.predict(dataset), assignments['cluster'].values[-len(dataset):])